@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+KEY_COLUMNS = ['FromIcao', 'ToIcao', 'UnitType', 'VIP']
+
+
+class AssignmentIndex(object):
+    # Assignments sorted once by (FromIcao, ToIcao, UnitType, VIP) so every group is a contiguous slice
+    def __init__(self, assignments):
+        keys = assignments[KEY_COLUMNS[:3]].assign(VIP=(assignments.Type == 'VIP').to_numpy())
+        group_ids = keys.groupby(KEY_COLUMNS, sort=True, observed=True).ngroup().to_numpy()
+        order = np.argsort(group_ids, kind='stable')
+        # Rows with a missing key never match a lookup, same as the old boolean masks
+        order = order[group_ids[order] >= 0]
+        group_ids = group_ids[order]
+
+        self.frame = assignments.iloc[order]
+        self.position = order
+        self.amount = self.frame.Amount.to_numpy()
+
+        self.starts = np.flatnonzero(np.r_[True, group_ids[1:] != group_ids[:-1]]) if len(order) else np.empty(0, int)
+        self.ends = np.r_[self.starts[1:], len(order)].astype(int)
+        first = keys.iloc[order[self.starts]] if len(order) else keys.iloc[:0]
+        self.group_keys = first.reset_index(drop=True)
+
+        self.slices = {}
+        for (from_icao, to_icao, unit_type, vip), start, end in zip(self.group_keys.itertuples(index=False, name=None),
+                                                                    self.starts, self.ends):
+            self.slices.setdefault((from_icao, to_icao), {})[(vip, unit_type)] = (start, end)
+        self.hashes = {}
+
+    def __len__(self):
+        return len(self.frame)
+
+    def routes(self):
+        return self.slices.keys()
+
+    def get(self, from_icao, to_icao, vip, unit_type, max_amount=None):
+        bounds = self.slices.get((from_icao, to_icao), {}).get((vip, unit_type))
+        if bounds is None:
+            return self.frame.iloc[:0]
+        start, end = bounds
+        if max_amount is None:
+            return self.frame.iloc[start:end]
+        return self.frame.iloc[start:end][self.amount[start:end] <= max_amount]
+
+    def get_candidates(self, from_icao, to_icao, vip, max_passengers, max_cargo):
+        # Passenger and cargo jobs that fit the aircraft, in their original order
+        groups = self.slices.get((from_icao, to_icao))
+        if groups is None:
+            return self.frame.iloc[:0]
+        positions = []
+        for unit_type, max_amount in (('passengers', max_passengers), ('kg', max_cargo)):
+            bounds = groups.get((vip, unit_type))
+            if bounds is None:
+                continue
+            rows = np.arange(*bounds)
+            positions.append(rows[self.amount[rows] <= max_amount])
+        if not positions:
+            return self.frame.iloc[:0]
+        rows = np.concatenate(positions)
+        return self.frame.iloc[rows[np.argsort(self.position[rows], kind='stable')]]
+
+    def route_hash(self, from_icao, to_icao):
+        # Fingerprint of every job between the two airports, stable across runs and independent of job order
+        if (from_icao, to_icao) not in self.hashes:
+            groups = self.slices.get((from_icao, to_icao), {})
+            rows = np.concatenate([np.arange(*bounds) for bounds in groups.values()]) if groups else np.empty(0, int)
+            jobs = self.frame.iloc[rows][['UnitType', 'Amount', 'Pay', 'Type']].astype(str)
+            self.hashes[(from_icao, to_icao)] = int(pd.util.hash_pandas_object(jobs).sum())
+        return self.hashes[(from_icao, to_icao)]
+
+    def aggregate(self):
+        # Sums per (FromIcao, ToIcao, UnitType); groups are already contiguous so this is a single reduceat
+        values = self.frame.select_dtypes(include=['number', 'bool'])
+        route_keys = self.group_keys[KEY_COLUMNS[:3]]
+        if not len(route_keys):
+            return pd.DataFrame(columns=KEY_COLUMNS[:3] + list(values.columns))
+        new_route = np.r_[True, (route_keys.iloc[1:].to_numpy() != route_keys.iloc[:-1].to_numpy()).any(axis=1)]
+        starts = self.starts[new_route]
+        aggregated = route_keys[new_route].reset_index(drop=True)
+        for column in values.columns:
+            column_values = values[column].to_numpy()
+            if column_values.dtype == bool:
+                column_values = column_values.astype(int)
+            aggregated[column] = np.add.reduceat(column_values, starts)
+        return aggregated
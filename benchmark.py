@@ -0,0 +1,240 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import common
+import const
+import geo
+import main
+from fseconomy import FSEconomy
+from memo import Memo
+
+SCALES = {'1k': 1000, '100k': 100000, '1M': 1000000}
+HISTORY_FILENAME = 'bench_history.jsonl'
+# Destinations are drawn from this many airports nearest to the origin
+DESTINATIONS = 30
+# Bumped whenever generate() changes, so runs on different synthetic data are not compared
+GENERATOR_VERSION = 2
+# A stage this much slower than the previous run of the same scale is reported as a regression
+REGRESSION_RATIO = 1.25
+
+
+def get_scale(value):
+    if value in SCALES:
+        return SCALES[value]
+    return int(float(value[:-1]) * {'k': 10 ** 3, 'M': 10 ** 6}[value[-1]]) if value[-1] in 'kM' else int(value)
+
+
+def generate(jobs, seed=0):
+    # Deterministic aircraft listing and job set on the real airports and models, written to the snapshot
+    # store in the current directory exactly like a fetch would leave them
+    rng = np.random.default_rng(seed)
+    airports = common.load_airports()
+    models = [model for model in const.ALLOWED_AIRCRAFTS if model in common.load_aircraft().index]
+
+    # Aircraft sit at a subset of the airports and jobs leave from there, like in the real feed. The first
+    # aircraft at every location is rentable: an origin without aircraft ends the search in do_work, which
+    # would leave the per-route stages with a handful of routes.
+    aircraft_count = max(1000, jobs // 25)
+    locations = airports.icao.astype(str).to_numpy()[
+        np.sort(rng.choice(len(airports), min(len(airports), max(500, jobs // 200)), replace=False))]
+    guaranteed = np.arange(aircraft_count) < len(locations)
+    aircraft = pd.DataFrame({
+        'SerialNumber': np.arange(aircraft_count) + 100000,
+        'MakeModel': rng.choice(models, aircraft_count),
+        'Registration': ['N{:06d}'.format(i) for i in range(aircraft_count)],
+        'Owner': 'Bank of FSE',
+        'Location': np.r_[locations, rng.choice(locations, aircraft_count - len(locations))],
+        'RentalDry': np.where(guaranteed, rng.choice([100.0, 200.0, 400.0], aircraft_count),
+                              rng.choice([0.0, 100.0, 200.0, 400.0], aircraft_count)),
+        'RentalWet': rng.choice([0.0, 150.0, 300.0, 600.0], aircraft_count),
+        'RentalType': 'hourly',
+        'RentalTime': rng.choice([2 * 3600, 5 * 3600, 10 * 3600], aircraft_count),
+        'RentedBy': 'Not rented.',
+        'PctFuel': rng.uniform(0.1, 1, aircraft_count),
+        'NeedsRepair': ((rng.random(aircraft_count) < 0.05) & ~guaranteed).astype(int),
+    }).set_index('SerialNumber')
+
+    grid = geo.AirportGrid(airports)
+    neighbours = np.array([grid.icao_nearest(icao, DESTINATIONS + 1)[0][1:] for icao in locations])
+    origin = rng.integers(0, len(locations), jobs)
+    destination = neighbours[origin, rng.integers(0, DESTINATIONS, jobs)]
+    passengers = rng.random(jobs) < 0.6
+    job_type = np.where(rng.random(jobs) < 0.05, 'VIP', np.where(rng.random(jobs) < 0.5, 'Trip-Only', 'All-In'))
+    assignments = pd.DataFrame({
+        'Id': np.arange(jobs) + 1,
+        'Location': locations[origin],
+        'ToIcao': airports.icao.astype(str).to_numpy()[destination],
+        'FromIcao': locations[origin],
+        'Amount': np.where(passengers, rng.integers(1, 20, jobs), rng.integers(10, 3000, jobs)),
+        'UnitType': np.where(passengers, 'passengers', 'kg'),
+        'Commodity': np.where(passengers, 'Passengers', 'Cargo'),
+        'Pay': rng.integers(100, 20000, jobs),
+        'Expires': '1 day',
+        'Type': job_type,
+        'Express': False,
+        'PtAssignment': rng.random(jobs) < 0.3,
+        'AircraftId': 0,
+    }).set_index('Id')
+
+    common.save_allowed_aircraft_airports(aircraft)
+    common.save_assignments(common.cast_assignments(assignments))
+
+
+def prepare_workdir(path):
+    # The loaders read icaodata.csv, aircraft.csv and the snapshots from the current directory
+    os.makedirs(path, exist_ok=True)
+    here = os.path.dirname(os.path.abspath(__file__))
+    for filename in (const.AIRPORTS_FILENAME, const.AIRCRAFT_FILENAME):
+        target = os.path.join(path, filename)
+        if not os.path.exists(target):
+            os.symlink(os.path.join(here, filename), target)
+    return path
+
+
+def get_max_rss_mb():
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class Stages(object):
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.results = {}
+
+    @contextlib.contextmanager
+    def time(self, name):
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            result = {'seconds': round(time.perf_counter() - start, 4), 'max_rss_mb': get_max_rss_mb()}
+            if self.trace_memory:
+                result['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+                tracemalloc.stop()
+            self.results[name] = result
+
+
+def run(jobs, seed=0, routes=100, radius=50, trace_memory=False):
+    stages = Stages(trace_memory)
+    with stages.time('generate'):
+        generate(jobs, seed)
+    with stages.time('load'):
+        fse = FSEconomy(True, memo=Memo())
+        # FSEconomy loads lazily; touch what do_work loads so the later stages do not pay for it
+        fse.assignment_index, fse.rentable_aircraft, fse.airport_grid
+    with stages.time('aggregate'):
+        aggregated = fse.get_aggregated_assignments()
+
+    origins = list(dict.fromkeys(aggregated.FromIcao.astype(str)))[:routes]
+    with stages.time('get_closest_airports'):
+        closest_airports = {icao: fse.get_closest_airports(icao, radius) for icao in origins}
+    with stages.time('get_close_aircraft'):
+        for icao in origins:
+            fse.get_close_aircraft_frame(icao, radius, closest_airports[icao])
+
+    # The knapsack stage solves the same instances evaluate_candidates would for the top routes: the
+    # candidates within fuel range and rental time
+    candidates, _ = main.build_candidates(fse, aggregated.head(routes), radius)
+    fuel_needed, seconds_needed, _, max_cargo, max_passengers = common.get_leg_limits(
+        fse.get_distances(candidates.FromIcao, candidates.ToIcao), candidates)
+    feasible = ((fuel_needed <= candidates.MaxFuel) & (candidates.RentalTime >= seconds_needed)).to_numpy()
+    with stages.time('knapsack'):
+        for from_icao, to_icao, passengers, cargo in zip(candidates.FromIcao[feasible], candidates.ToIcao[feasible],
+                                                          max_passengers[feasible], max_cargo[feasible]):
+            if passengers >= 0 and cargo >= 0:
+                fse.get_best_assignments({'FromIcao': from_icao, 'ToIcao': to_icao,
+                                          'MaxPassengers': int(passengers), 'MaxCargo': int(cargo)})
+
+    args = main.get_parser().parse_args(['--local', '--skey', 'benchmark', '--limit', str(routes), '--radius',
+                                         str(radius), '--min', '0'])
+    with stages.time('do_work'), contextlib.redirect_stdout(io.StringIO()):
+        main.do_work(args)
+    return stages.results
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def report(record, previous):
+    print('{} jobs (seed {}), commit {}'.format(record['jobs'], record['seed'], record['commit']))
+    for name, result in record['stages'].items():
+        line = '  {:<22}{:>10.3f}s {:>9.1f} MB rss'.format(name, result['seconds'], result['max_rss_mb'])
+        if 'peak_mb' in result:
+            line += ' {:>9.1f} MB peak'.format(result['peak_mb'])
+        before = previous['stages'].get(name) if previous else None
+        if before and before['seconds'] > 0:
+            ratio = result['seconds'] / before['seconds']
+            line += '  x{:.2f} vs {}'.format(ratio, previous['commit'])
+            if ratio > REGRESSION_RATIO:
+                line += '  REGRESSION'
+        print(line)
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description='Times the pipeline stages on synthetic data sets')
+    parser.add_argument('--scales', help='Job counts, e.g. 1k 100k 1M', nargs='+', default=['1k', '100k'])
+    parser.add_argument('--seed', help='Seed of the synthetic data', type=int, default=0)
+    parser.add_argument('--routes', help='Routes searched by the per-route stages and do_work', type=int,
+                        default=100)
+    parser.add_argument('--radius', help='Radius for aircraft search (nm)', type=int, default=50)
+    parser.add_argument('--workdir', help='Directory the synthetic snapshots are written to',
+                        default='benchmark_data')
+    parser.add_argument('--history', help='JSON lines file every run is appended to', default=HISTORY_FILENAME)
+    parser.add_argument('--trace-memory', help='Also record the traced peak per stage (slows every stage down)',
+                        action='store_true')
+    args = parser.parse_args()
+
+    history_path = os.path.abspath(args.history)
+    history = load_history(history_path)
+    commit = get_commit()
+    for scale in args.scales:
+        jobs = get_scale(scale)
+        # rss is the high-water mark of the whole process, so it only compares between runs of the same
+        # scale list
+        workdir = prepare_workdir(os.path.abspath(os.path.join(args.workdir, str(jobs))))
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            stages = run(jobs, args.seed, args.routes, args.radius, args.trace_memory)
+        finally:
+            os.chdir(cwd)
+        record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'generator': GENERATOR_VERSION,
+                  'jobs': jobs, 'seed': args.seed, 'routes': args.routes, 'radius': args.radius,
+                  'trace_memory': args.trace_memory, 'stages': stages}
+        # Only runs with the same settings are comparable; tracing alone makes every stage slower
+        key = ('generator', 'jobs', 'seed', 'routes', 'radius', 'trace_memory')
+        previous = [r for r in history if all(r.get(k) == record[k] for k in key)]
+        report(record, previous[-1] if previous else None)
+        history.append(record)
+        with open(history_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -1,26 +1,74 @@
+import functools
+import os
+import numpy as np
 import pandas as pd
 import pickle
+import random
 import time
 from math import atan2, cos, pow, sin, sqrt
 
 import const
+import schema
+import store
+
+
+def load_static(filename, parse):
+    # The CSVs shipped with the tool are parsed once and kept as a memory-mapped snapshot; a different mtime
+    # or size of the CSV, or a new STATIC_CACHE_VERSION, compiles it again
+    path = os.path.join(const.STATIC_CACHE, os.path.splitext(os.path.basename(filename))[0])
+    source = os.stat(filename)
+    stamp = {'mtime': source.st_mtime_ns, 'size': source.st_size, 'version': const.STATIC_CACHE_VERSION}
+    try:
+        if store.snapshot_exists(path) and store.read_extra(path) == stamp:
+            return store.read_snapshot(path)
+    except (OSError, ValueError, KeyError, store.SnapshotVersionError):
+        pass
+    frame = parse(filename)
+    try:
+        store.write_snapshot(path, frame, extra=stamp)
+    except OSError:
+        # Read-only installs just parse every time
+        return frame
+    # Read back so the first run sees the same dtypes as the cached ones
+    return store.read_snapshot(path)
+
+
+def parse_airports(filename):
+    return schema.airports(pd.read_csv(filename))
 
 
 def load_airports():
-    airports = pd.read_csv(const.AIRPORTS_FILENAME)
-    airports.lat = airports.lat.astype(float)
-    airports.lon = airports.lon.astype(float)
-    return airports
+    return load_static(const.AIRPORTS_FILENAME, parse_airports)
 
 
-def load_aircraft():
-    aircraft = pd.read_csv(const.AIRCRAFT_FILENAME)
+def parse_aircraft(filename):
+    aircraft = pd.read_csv(filename)
     aircraft.columns = ['Model', 'Crew', 'Seats', 'CruiseSpeed', 'GPH', 'FuelType', 'MTOW', 'EmptyWeight', 'Price',
                         'Ext1', 'LTip', 'LAux', 'LMain', 'Center1', 'Center2', 'Center3', 'RMain', 'RAux', 'RTip',
                         'RExt2', 'Engines', 'EnginePrice', 'ModelId', 'Blank']
     aircraft.Seats = aircraft.Seats.astype(int)
     aircraft.Crew = aircraft.Crew.astype(int)
     aircraft.CruiseSpeed = aircraft.CruiseSpeed.astype(float)
+    # A few rows of the model dump carry garbled weights; those models get no payload
+    aircraft.MTOW = pd.to_numeric(aircraft.MTOW, errors='coerce')
+    aircraft.EmptyWeight = pd.to_numeric(aircraft.EmptyWeight, errors='coerce')
+    aircraft['MaxFuel'] = get_max_fuel(aircraft)
+    aircraft['FuelWeight'] = np.where(aircraft.FuelType == 1, const.JET_A_WEIGHT, const.LL_WEIGHT)
+    aircraft['MaxFuelWeight'] = np.round(aircraft.MaxFuel * aircraft.FuelWeight)
+    aircraft['BasePayload'] = aircraft.MTOW // 1 - aircraft.EmptyWeight // 1 - (
+            const.PAX_WEIGHT_KG * (1 + aircraft.Crew))
+    aircraft['FullFuelPayload'] = np.round(aircraft.BasePayload - aircraft.MaxFuel * const.GALLONS_TO_KG)
+    aircraft['PassengerSeats'] = aircraft.Seats - np.where(aircraft.Crew > 0, 2, 1)
+    return aircraft.set_index(aircraft.Model.rename('MakeModel'))
+
+
+@functools.lru_cache(maxsize=None)
+def load_aircraft(filename=const.AIRCRAFT_FILENAME):
+    # Model table with the per-model values that never change precomputed, indexed by model name.
+    # Cached, so treat the result as read-only.
+    aircraft = load_static(filename, parse_aircraft)
+    # The snapshot keeps strings as categories; the index is joined against listings, so it stays plain
+    aircraft.index = aircraft.index.astype(str)
     return aircraft
 
 
@@ -36,6 +84,20 @@ def get_ratio(x, earnings_column):
     return round(x[earnings_column] / ((x['Distance'] + x['CraftDistance']) / x['aircraft']['CruiseSpeed']), 2)
 
 
+def get_earnings_columns(frame, rent_type):
+    # get_earnings over whole columns
+    res = frame['Pay'].astype(float)
+    pt_amount = frame['PtAssignment']
+    res = np.where(pt_amount > 6, res - res * pt_amount / 100, res)
+    return np.where(frame[rent_type] != 0, np.round(res - frame[rent_type], 2), 0)
+
+
+def get_ratio_columns(frame, earnings_column):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.round(frame[earnings_column] / ((frame['Distance'] + frame['CraftDistance']) / frame['CruiseSpeed']),
+                        2)
+
+
 def get_distance(lat1, lon1, lat2, lon2):
     r = 6371000
     dlon = lon2 - lon1
@@ -45,16 +107,44 @@ def get_distance(lat1, lon1, lat2, lon2):
     return round((r * c) / 1850, 1)
 
 
-def load_pickled_assignments():
-    with open('assignments', 'rb') as f:
-        assignments = pickle.load(f)
+def cast_assignments(assignments):
     assignments.Pay = assignments.Pay.astype(int)
     assignments.Amount = assignments.Amount.astype(int)
-    assignments.PtAssignment = assignments.PtAssignment.map(lambda x: True if x == 'true' else False)
+    if assignments.PtAssignment.dtype != bool:
+        assignments.PtAssignment = assignments.PtAssignment.map(lambda x: True if str(x).lower() == 'true' else False)
     assignments.UnitType = assignments.UnitType.astype(str)
     return assignments
 
 
+def load_assignments(columns=None, from_icaos=None):
+    if not store.snapshot_exists(const.ASSIGNMENTS_SNAPSHOT) and os.path.exists('assignments'):
+        return load_pickled_assignments()
+    where = {'FromIcao': from_icaos} if from_icaos is not None else None
+    return store.read_snapshot(const.ASSIGNMENTS_SNAPSHOT, columns, where)
+
+
+def save_assignments(assignments):
+    store.write_snapshot(const.ASSIGNMENTS_SNAPSHOT, assignments, partition_by='FromIcao')
+
+
+def load_allowed_aircraft_airports(columns=None, locations=None):
+    if not store.snapshot_exists(const.AIRCRAFT_LOCATIONS_SNAPSHOT) and os.path.exists('airports'):
+        return load_pickled_allowed_aircraft_airports()
+    where = {'Location': locations} if locations is not None else None
+    return store.read_snapshot(const.AIRCRAFT_LOCATIONS_SNAPSHOT, columns, where)
+
+
+def save_allowed_aircraft_airports(airports):
+    store.write_snapshot(const.AIRCRAFT_LOCATIONS_SNAPSHOT, airports, partition_by='Location')
+
+
+def load_pickled_assignments():
+    # Dumps written before the snapshot store
+    with open('assignments', 'rb') as f:
+        assignments = pickle.load(f)
+    return cast_assignments(assignments)
+
+
 def load_pickled_allowed_aircraft_airports():
     with open('airports', 'rb') as f:
         airports = pickle.load(f)
@@ -66,14 +156,23 @@ def retry(func, *args, **kwargs):
     count = kwargs.pop("count", 10)
     error_type = kwargs.pop("error_type", Exception)
     interval = kwargs.pop("interval", 60)
+    # Exponential backoff: the n-th wait is interval * backoff ** (n - 1), capped and spread by +/- jitter
+    backoff = kwargs.pop("backoff", 1)
+    max_interval = kwargs.pop("max_interval", interval)
+    jitter = kwargs.pop("jitter", 0)
+    on_error = kwargs.pop("on_error", None)
     while True:
         try:
             return func(*args, **kwargs)
-        except error_type:
+        except error_type as e:
             if c >= count:
                 raise
+            delay = min(interval * pow(backoff, c - 1), max(interval, max_interval))
+            delay *= random.uniform(1 - jitter, 1 + jitter)
+            if on_error is not None:
+                on_error(e, delay)
             c += 1
-            time.sleep(interval)
+            time.sleep(delay)
 
 
 def get_total_fuel(aircraft):
@@ -99,9 +198,25 @@ def get_fuel_weight(aircraft):
 
 def get_estimated_fuel_needed(distance, aircraft):
     # Add 1.5 hours
-    return (((round(distance / aircraft['CruiseSpeed'], 1)) * aircraft['GPH']) + (
+    return (((np.round(distance / aircraft['CruiseSpeed'], 1)) * aircraft['GPH']) + (
             aircraft['GPH'] * 1.5))
 
 
 def get_estimated_fuel_needed_weight(distance, aircraft):
     return round(get_estimated_fuel_needed(distance, aircraft) * get_fuel_weight(aircraft))
+
+
+def get_leg_limits(distance, aircraft):
+    # Fuel needed, flight time in seconds, fuel on board and payload limits for flying distance; works on
+    # scalars and on whole columns
+    fuel_cap = aircraft['MaxFuel']
+    payload75 = aircraft['FullFuelPayload']
+    payload100 = aircraft['FullFuelPayload']
+    total_fuel = np.round(fuel_cap * aircraft['PctFuel'])
+    fuel_needed = get_estimated_fuel_needed(distance, aircraft)
+    seconds_needed = fuel_needed / aircraft['GPH'] * 60 * 60
+    fuel_for_trip = np.maximum(fuel_needed, total_fuel)
+    percent = np.minimum(fuel_for_trip / fuel_cap * 100, 100)
+    max_cargo = np.floor((100 - percent) * ((payload75 - payload100) / 25) + payload100)
+    max_passengers = np.minimum(aircraft['PassengerSeats'], np.floor(max_cargo / const.PAX_WEIGHT_KG))
+    return fuel_needed, seconds_needed, fuel_for_trip, max_cargo, max_passengers
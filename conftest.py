@@ -0,0 +1,13 @@
+import pytest
+
+import benchmark
+from fseconomy import FSEconomy
+from memo import Memo
+
+
+@pytest.fixture
+def fse(tmp_path, monkeypatch):
+    # A local FSEconomy on a small synthetic data set written to a scratch working directory
+    monkeypatch.chdir(benchmark.prepare_workdir(str(tmp_path)))
+    benchmark.generate(1000, seed=0)
+    return FSEconomy(True, memo=Memo())
@@ -2,6 +2,39 @@ AIRPORTS_FILENAME = 'icaodata.csv'
 AIRCRAFT_FILENAME = 'aircraft.csv'
 LINK = 'http://server.fseconomy.net/data?format=csv&'
 
+# Request rate per key type as (requests per second, burst size)
+RATE_LIMITS = {
+    'servicekey': (1 / 2.0, 2),
+    'userkey': (1 / 7.0, 1),
+    None: (1 / 7.0, 1),
+}
+FETCH_WORKERS = 4
+
+ASSIGNMENTS_SNAPSHOT = 'assignments.snapshot'
+AIRCRAFT_LOCATIONS_SNAPSHOT = 'airports.snapshot'
+
+# Memory-mapped copies of icaodata.csv and aircraft.csv; bump the version when their parsing changes
+STATIC_CACHE = 'static.snapshot'
+STATIC_CACHE_VERSION = 1
+
+JOB_CACHE_FILENAME = 'jobcache'
+# Seconds before the jobs of an airport are fetched again
+JOB_CACHE_TTL = 15 * 60
+
+# Entries per memo cache (distances, knapsack selections)
+MEMO_SIZE = 200000
+# Bumped whenever the cached values change meaning, so older backing files are ignored
+MEMO_VERSION = 2
+
+SERVICE_PORT = 8585
+# Seconds between background refreshes of the service
+SERVICE_REFRESH_INTERVAL = 5 * 60
+# Aircraft listings take one request per model, so the service fetches them again less often than jobs
+SERVICE_AIRCRAFT_TTL = 30 * 60
+
+# Earnings a search can rank by and the rent column each is computed from
+RENT_COLUMNS = {'DryEarnings': 'RentalDry', 'WetEarnings': 'RentalWet'}
+
 # Passenger weight in kg
 PAX_WEIGHT_KG = 77
 
@@ -0,0 +1,208 @@
+import http.client
+import io
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import pandas as pd
+
+import common
+import const
+from instrument import stats
+
+log = logging.getLogger(__name__)
+
+
+class TooManyConnectionsException(Exception):
+    pass
+
+
+class ServerUnreachableException(Exception):
+    pass
+
+
+class ServerErrorException(Exception):
+    pass
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Throttled by the server: nobody sends anything for a while and the burst starts empty
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class Fetcher(object):
+    def __init__(self, service_key=None, user_key=None, workers=const.FETCH_WORKERS, rate_limits=None,
+                 retry_count=10, retry_interval=5, max_retry_interval=120, jitter=0.25):
+        self.service_key = service_key
+        self.user_key = user_key
+        self.key_type = 'servicekey' if service_key else 'userkey' if user_key else None
+        rate, capacity = (rate_limits or const.RATE_LIMITS)[self.key_type]
+        self.bucket = TokenBucket(rate, capacity)
+        self.workers = workers
+        self.retry_count = retry_count
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.jitter = jitter
+        # Per-thread connections
+        self.local = threading.local()
+
+    def __getstate__(self):
+        # Worker processes get a copy without the connections, which they open again on first use
+        state = self.__dict__.copy()
+        del state['local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def with_key(self, query_link):
+        if self.service_key:
+            query_link += '&servicekey={}'.format(self.service_key)
+        elif self.user_key:
+            query_link += '&userkey={}'.format(self.user_key)
+        return query_link
+
+    def get(self, query_link):
+        return self.retry(self.request, query_link)
+
+    def get_frame(self, query_link):
+        return self.retry(self.request_frame, query_link)
+
+    def retry(self, request, query_link):
+        # A failed or throttled request is retried on its own, the rest of the crawl carries on
+        return common.retry(request, query_link, count=self.retry_count,
+                            error_type=(TooManyConnectionsException, ServerErrorException,
+                                        http.client.HTTPException, OSError, pd.errors.ParserError,
+                                        pd.errors.EmptyDataError),
+                            interval=self.retry_interval, backoff=2, max_interval=self.max_retry_interval,
+                            jitter=self.jitter, on_error=self.on_error)
+
+    def map(self, query_links, fetch=None):
+        # Downloads run on the thread pool while the caller consumes finished results in order. At most
+        # one result per worker is waiting, so memory is bounded by the request size, not the crawl.
+        fetch = fetch or self.get
+        query_links = iter(query_links)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for query_link in itertools.islice(query_links, self.workers):
+                pending.append(executor.submit(fetch, query_link))
+            while pending:
+                result = pending.popleft().result()
+                for query_link in itertools.islice(query_links, 1):
+                    pending.append(executor.submit(fetch, query_link))
+                yield result
+
+    def on_error(self, error, delay):
+        stats.count('fetch.retries')
+        log.info('Retrying in %.1fs after %s', delay, error)
+        if isinstance(error, TooManyConnectionsException):
+            stats.count('fetch.throttled')
+            self.bucket.pause(delay)
+        else:
+            self.close()
+
+    def open(self, query_link):
+        with stats.timer('rate_limit'):
+            self.bucket.acquire()
+        stats.count('fetch.requests')
+        url = urlsplit(self.with_key(query_link))
+        with stats.timer('fetch'):
+            connection = self.connection(url)
+            connection.request('GET', '{}?{}'.format(url.path or '/', url.query))
+            response = connection.getresponse()
+            if response.status >= 400:
+                # The body is read either way so the connection can be reused for the retry
+                message = '{} {}'.format(response.status, self.decode(response, response.read()))
+                if response.status == 429:
+                    raise TooManyConnectionsException(message)
+                if response.status >= 500:
+                    raise ServerErrorException(message)
+                raise ServerUnreachableException(message)
+        return response
+
+    def request(self, query_link):
+        response = self.open(query_link)
+        with stats.timer('fetch'):
+            body = response.read()
+        return self.check(self.decode(response, body))
+
+    def request_frame(self, query_link):
+        # Parses the CSV straight off the socket instead of holding the body as a string. The feed
+        # reports errors as a plain text body, which parses to a header without rows.
+        response = self.open(query_link)
+        # The body arrives while it is parsed, so this stage includes the transfer
+        with stats.timer('parse'):
+            frame = pd.read_csv(io.TextIOWrapper(response,
+                                                 encoding=response.headers.get_content_charset() or 'utf-8'))
+        if not len(frame):
+            self.check(','.join(map(str, frame.columns)))
+        return frame.set_index(frame.columns[0]) if len(frame.columns) else frame
+
+    @staticmethod
+    def decode(response, body):
+        return body.decode(response.headers.get_content_charset() or 'utf-8')
+
+    @staticmethod
+    def check(result):
+        if 'many requests in 60 second period' in result:
+            log.warning('Too many requests error. Use sevice key to avoid this error.')
+            raise TooManyConnectionsException(result)
+        if 'request was under the minimum delay' in result:
+            raise TooManyConnectionsException(result)
+        if 'Currently Closed for Maintenance' in result:
+            raise ServerUnreachableException(result)
+        return result
+
+    def connection(self, url):
+        # One keep-alive connection per thread and host
+        key = (url.scheme, url.netloc)
+        if getattr(self.local, 'key', None) != key:
+            self.close()
+            connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+            self.local.connection = connection_class(url.netloc, timeout=60)
+            self.local.key = key
+        return self.local.connection
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+        self.local.connection = None
+        self.local.key = None
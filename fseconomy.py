@@ -1,43 +1,103 @@
+import functools
+import logging
 from urllib.parse import quote
 import pandas as pd
 # import modin.pandas as pd
 from io import StringIO
-from urllib.request import urlopen
-from math import radians
-import pickle
 import numpy as np
-from pulp import LpMaximize, LpProblem, LpVariable
-import time
 import common
 import const
+import geo
+import knapsack
+import schema
+from assignments import AssignmentIndex
+from fetch import Fetcher, ServerUnreachableException, TooManyConnectionsException
+from instrument import stats
+from memo import MISSING, Memo
 
-
-class TooManyConnectionsException(Exception):
-    pass
-
-
-class ServerUnreachableException(Exception):
-    pass
+log = logging.getLogger(__name__)
 
 
 class FSEconomy(object):
-    def __init__(self, local, service_key=None, user_key=None):
-        self.last_request_time = time.time()
+    def __init__(self, local, service_key=None, user_key=None, solver='auto', link=const.LINK, fetcher=None,
+                 job_cache=None, refresh_limit=None, memo=None, shard=None):
         self.service_key = service_key
         self.user_key = user_key
+        self.solver = solver
+        self.link = link
+        self.fetcher = fetcher or Fetcher(service_key, user_key)
+        self.job_cache = job_cache
+        self.refresh_limit = refresh_limit
+        self.memo = memo or Memo()
+        self.local = local
+        # A shard.Shard limits the crawl to its home airports and the aircraft to its halo around them
+        self.shard = shard
+
+    # Everything below is loaded on first use, so a run only pays for the data it touches. In online mode the
+    # first access fetches; assignments need the airports, which need the aircraft locations.
+    @functools.cached_property
+    def all_airports(self):
+        return common.load_airports()
+
+    @functools.cached_property
+    def icao_dtype(self):
+        return self.all_airports.icao.dtype
+
+    @functools.cached_property
+    def airport_index(self):
+        return geo.AirportIndex(self.all_airports)
+
+    @functools.cached_property
+    def aircraft(self):
+        return common.load_aircraft()
+
+    @functools.cached_property
+    def allowed_aircraft_airports(self):
+        if self.local:
+            allowed_aircraft_airports = common.load_allowed_aircraft_airports()
+        else:
+            allowed_aircraft_airports = self.get_allowed_aircraft_airports()
+        allowed_aircraft_airports = schema.aircraft_locations(allowed_aircraft_airports, self.icao_dtype)
+        if self.shard is not None:
+            allowed_aircraft_airports = allowed_aircraft_airports[
+                allowed_aircraft_airports.Location.astype(str).isin(self.shard.halo).to_numpy()]
+        return allowed_aircraft_airports
 
-        self.all_airports = common.load_airports()
-        self.aircraft = common.load_aircraft()
-        # self.aircraft = self.load_aircraft()
-
-        if local:
-            self.allowed_aircraft_airports = common.load_pickled_allowed_aircraft_airports()
-            self.airports = self.get_airports()
-            self.assignments = common.load_pickled_assignments()
+    @functools.cached_property
+    def airports(self):
+        return self.get_airports()
+
+    @functools.cached_property
+    def origins(self):
+        # Airports whose jobs are searched
+        if self.shard is None:
+            return self.airports
+        return self.airports[self.airports.icao.astype(str).isin(self.shard.home).to_numpy()]
+
+    @functools.cached_property
+    def assignments(self):
+        if self.local:
+            from_icaos = sorted(self.shard.home) if self.shard is not None else None
+            assignments = common.load_assignments(from_icaos=from_icaos)
         else:
-            self.allowed_aircraft_airports = self.get_allowed_aircraft_airports()
-            self.airports = self.get_airports()
-            self.assignments = self.get_assignments()
+            assignments = self.get_assignments()
+        assignments = schema.assignments(assignments, self.icao_dtype)
+        if self.shard is not None:
+            # The pickled dumps have no partitions to push the filter into
+            assignments = assignments[assignments.FromIcao.astype(str).isin(self.shard.home).to_numpy()]
+        return assignments
+
+    @functools.cached_property
+    def airport_grid(self):
+        return geo.AirportGrid(self.airports)
+
+    @functools.cached_property
+    def rentable_aircraft(self):
+        return self.get_rentable_aircraft()
+
+    @functools.cached_property
+    def assignment_index(self):
+        return AssignmentIndex(self.assignments)
 
     def load_aircraft(self):
         data = StringIO(self.get_aircraft())
@@ -54,94 +114,106 @@ class FSEconomy(object):
         return self.all_airports[self.all_airports.icao.isin(self.allowed_aircraft_airports.Location)]
 
     def get_allowed_aircraft_airports(self):
-        allowed_aircraft_airports = pd.DataFrame()
-        for allowed_aircraft in const.ALLOWED_AIRCRAFTS:
-            data = StringIO(self.get_airports_for(allowed_aircraft))
-            allowed_aircraft_airports = pd.concat(
-                [allowed_aircraft_airports, pd.read_csv(data, index_col=0, parse_dates=True)])
+        links = [self.get_airports_for_link(allowed_aircraft) for allowed_aircraft in const.ALLOWED_AIRCRAFTS]
+        allowed_aircraft_airports = self.concat(self.stream_frames(links, self.parse_aircraft_locations))
 
-        with open('airports', 'wb') as f:
-            pickle.dump(allowed_aircraft_airports, f)
+        common.save_allowed_aircraft_airports(allowed_aircraft_airports)
 
         return allowed_aircraft_airports
 
     def get_assignments(self):
-        assignments = pd.DataFrame()
-
-        i = 0
-        lim = len(self.airports)
-        while i + 1500 < lim:
-            data = StringIO(self.get_jobs_from(self.airports.icao[i:i + 1500]))
-            assignments = pd.concat([assignments, pd.read_csv(data, index_col=0, parse_dates=True)])
-            i += 1500
-            print(i)
-        data = StringIO(self.get_jobs_from(self.airports.icao[i:lim - 1]))
-        assignments = pd.concat([assignments, pd.read_csv(data, index_col=0, parse_dates=True)])
-        with open('assignments', 'wb') as f:
-            pickle.dump(assignments, f)
+        if self.job_cache is not None:
+            assignments = self.refresh_assignments(self.refresh_limit)
+        else:
+            icaos = self.origins.icao.astype(str).tolist()
+            lim = len(icaos)
+            links = [self.get_jobs_from_link(icaos[i:i + 1500]) for i in range(0, lim, 1500)]
+            chunks = []
+            for n, data in enumerate(self.stream_frames(links, self.parse_jobs), 1):
+                chunks.append(data)
+                log.info('Fetched jobs for %d of %d airports', min(n * 1500, lim), lim)
+            assignments = self.concat(chunks)
+        common.save_assignments(assignments)
         return assignments
 
+    def refresh_assignments(self, limit=None):
+        # Only airports whose cached jobs are missing or older than the cache TTL are fetched again
+        icaos = self.job_cache.expired(self.origins.icao)[:limit]
+        chunks = [icaos[i:i + 1500] for i in range(0, len(icaos), 1500)]
+        links = [self.get_jobs_from_link(chunk) for chunk in chunks]
+        log.info('Refreshing jobs for %d of %d airports', len(icaos), len(self.origins))
+        if chunks:
+            self.job_cache.update(icaos, self.concat(self.stream_frames(links, self.parse_jobs)))
+            self.job_cache.save()
+        return self.job_cache.get(self.origins.icao)
+
     def get_aggregated_assignments(self):
-        grouped = self.assignments.groupby(['FromIcao', 'ToIcao', 'UnitType'], as_index=False)
-        aggregated = grouped.aggregate(np.sum)
+        aggregated = self.assignment_index.aggregate()
         return aggregated.sort_values('Pay', ascending=False)
 
     def get_best_assignments(self, row):
-        df = self.assignments[((self.assignments.FromIcao == row['FromIcao']) &
-                               (self.assignments.ToIcao == row['ToIcao']) &
-                               (self.assignments.Type != 'VIP') &
-                               (self.assignments.Amount <= row['MaxPassengers']) &
-                               (self.assignments.UnitType == 'passengers')) |
-                              ((self.assignments.FromIcao == row['FromIcao']) &
-                               (self.assignments.ToIcao == row['ToIcao']) &
-                               (self.assignments.Type != 'VIP') &
-                               (self.assignments.Amount <= row['MaxCargo']) &
-                               (self.assignments.UnitType == 'kg'))]
-
-        if not len(df):
+        key = ('best', row['FromIcao'], row['ToIcao'], row['MaxPassengers'], row['MaxCargo'], self.solver,
+               self.assignment_index.route_hash(row['FromIcao'], row['ToIcao']))
+        cached = self.memo.assignments.get(key)
+        if cached is not MISSING:
+            stats.count('knapsack.cached')
+            if cached is None:
+                return None
+            vip, selected = cached
+            if vip:
+                return self.get_best_vip_assignment(row)
+            return self.get_weighted_assignments(row).loc[list(selected)]
+
+        df = self.get_weighted_assignments(row)
+        if df is None:
+            self.memo.assignments.put(key, None)
             return None
 
-        dfd = df.copy()
-        mask = dfd['UnitType'].str.match('passengers')
-
-        dfd.loc[mask, 'Passengers'] = dfd['Amount']
-        dfd['Passengers'] = dfd['Passengers'].fillna(0)
-        dfd.loc[mask, 'Amount'] *= const.PAX_WEIGHT_KG
-
-        prob = LpProblem("KnapsackProblem", LpMaximize)
-        weight_list = dfd.Amount.tolist()
-        pax_list = dfd.Passengers.tolist()
-        pay_list = dfd.Pay.tolist()
-        x_list = [LpVariable('x{}'.format(i), 0, 1, 'Integer') for i in range(1, 1 + len(weight_list))]
-        prob += sum([x * p for x, p in zip(x_list, pay_list)]), 'obj'
-        prob += sum([x * w for x, w in zip(x_list, pax_list)]) <= row['MaxPassengers'], 'c1'
-        prob += sum([x * w for x, w in zip(x_list, weight_list)]) <= row['MaxCargo'], 'c2'
-        prob.solve()
-        best_assignments = dfd.iloc[[i for i in range(len(x_list)) if x_list[i].varValue]]
+        stats.count('knapsack.solved')
+        with stats.timer('knapsack'):
+            selected = knapsack.solve(df.Pay.to_numpy(), df.Passengers.to_numpy(), df.Amount.to_numpy(),
+                                      row['MaxPassengers'], row['MaxCargo'], self.solver)
+        best_assignments = df.iloc[selected]
 
         best_vip_assignment = self.get_best_vip_assignment(row)
 
         if best_vip_assignment is not None and (sum(best_vip_assignment['Pay']) >= sum(best_assignments['Pay'])):
+            self.memo.assignments.put(key, (True, ()))
             return best_vip_assignment
 
+        self.memo.assignments.put(key, (False, tuple(best_assignments.index.tolist())))
         return best_assignments
 
-    def get_best_vip_assignment(self, row):
-        df = self.assignments[((self.assignments.FromIcao == row['FromIcao']) &
-                               (self.assignments.ToIcao == row['ToIcao']) &
-                               (self.assignments.Type == 'VIP') &
-                               (self.assignments.Amount <= row['MaxPassengers']) &
-                               (self.assignments.UnitType == 'passengers')) |
-                              ((self.assignments.FromIcao == row['FromIcao']) &
-                               (self.assignments.ToIcao == row['ToIcao']) &
-                               (self.assignments.Type == 'VIP') &
-                               (self.assignments.Amount <= row['MaxCargo']) &
-                               (self.assignments.UnitType == 'kg'))]
+    def get_weighted_assignments(self, row):
+        # Jobs that fit, with passenger jobs counted in seats and in kg
+        df = self.assignment_index.get_candidates(row['FromIcao'], row['ToIcao'], False, row['MaxPassengers'],
+                                                  row['MaxCargo'])
 
         if not len(df):
             return None
 
-        return df.sort_values('Pay', ascending=False).head(1)
+        dfd = df.copy()
+        mask = dfd['UnitType'].str.match('passengers')
+
+        dfd.loc[mask, 'Passengers'] = dfd['Amount']
+        dfd['Passengers'] = dfd['Passengers'].fillna(0)
+        dfd.loc[mask, 'Amount'] *= const.PAX_WEIGHT_KG
+        return dfd
+
+    def get_best_vip_assignment(self, row):
+        key = ('vip', row['FromIcao'], row['ToIcao'], row['MaxPassengers'], row['MaxCargo'],
+               self.assignment_index.route_hash(row['FromIcao'], row['ToIcao']))
+        df = self.assignment_index.get_candidates(row['FromIcao'], row['ToIcao'], True, row['MaxPassengers'],
+                                                  row['MaxCargo'])
+        best = self.memo.assignments.get(key)
+        if best is MISSING:
+            best = df.index[int(np.argmax(df.Pay.to_numpy()))] if len(df) else None
+            self.memo.assignments.put(key, best)
+
+        if best is None:
+            return None
+
+        return df.loc[[best]]
 
     def get_aircraft_by_icao(self, icao):
         aircrafts = self.allowed_aircraft_airports[self.allowed_aircraft_airports.Location == icao]
@@ -152,78 +224,102 @@ class FSEconomy(object):
         # aircrafts.RentalWet = aircrafts.RentalWet.astype(float)
         return aircrafts
 
-    def get_close_aircraft(self, icao, radius):
-        print('Searching for the best aircraft from {}'.format(icao))
-        best_aircraft = []
-        closest_airports = self.get_closest_airports(icao, radius)
+    def get_rentable_aircraft(self):
+        # The aircraft with the most seats at each airport, joined to the model table once
+        listing = self.allowed_aircraft_airports
+        if 'RentalDry' not in listing.columns or 'RentalWet' not in listing.columns:
+            return pd.DataFrame(columns=list(listing.columns) + list(self.aircraft.columns))
+        merged = listing.join(self.aircraft, on='MakeModel', how='inner').reset_index()
+        merged = merged[(merged.NeedsRepair != 1) & (merged.RentalWet + merged.RentalDry > 0) &
+                        merged.BasePayload.notna()]
+        best = merged.loc[merged.groupby('Location', observed=True).Seats.idxmax()]
+        return best.set_index(best.Location.astype(str).rename(None))
+
+    def get_close_aircraft_frame(self, icao, radius, closest_airports=None):
+        if closest_airports is None:
+            closest_airports = self.get_closest_airports(icao, radius)
         if closest_airports is None:
             return None
+        near_icaos = closest_airports.icao.astype(str)
+        return self.rentable_aircraft.loc[near_icaos[near_icaos.isin(self.rentable_aircraft.index)]]
 
-        for near_icao in closest_airports.icao:
-            print('--Searching for the best aircraft from {}'.format(near_icao))
-            aircraft = self.get_aircraft_by_icao(near_icao)
-            if not len(aircraft):
-                continue
-            merged = pd.DataFrame.merge(aircraft, self.aircraft, left_on='MakeModel', right_on='Model', how='inner')
-            merged = merged[
-                     (merged.NeedsRepair != 1) & (merged.RentalWet + merged.RentalDry > 0)]
-            if not len(merged):
-                continue
-            aircraft = merged.loc[merged.Seats.idxmax()]
-            best_aircraft.append(aircraft)
-        return best_aircraft
+    def get_close_aircraft(self, icao, radius, closest_airports=None):
+        log.debug('Searching for the best aircraft from %s', icao)
+        close_aircraft = self.get_close_aircraft_frame(icao, radius, closest_airports)
+        if close_aircraft is None:
+            return None
+        return [aircraft for _, aircraft in close_aircraft.iterrows()]
 
     def get_closest_airports(self, icao, nm):
-        airports_to_use = self.airports[self.airports.icao == icao]
-        if len(airports_to_use) == 0:
+        if icao not in self.airport_grid:
             return None
-
-        lat = airports_to_use.lat.iloc[0]
-        nm = float(nm)
-        # one degree of latitude is appr. 69 nm
-        lat_min = lat - nm / 69
-        lat_max = lat + nm / 69
-        filtered_airports = self.airports[self.airports.lat > lat_min]
-        filtered_airports = filtered_airports[filtered_airports.lat < lat_max]
-        distance_vector = filtered_airports.icao.map(lambda x: self.get_distance(icao, x))
-        return filtered_airports[distance_vector < nm]
+        return self.airports.iloc[self.airport_grid.icao_within(icao, float(nm))]
+
+    def get_closest_airports_many(self, icaos, nm):
+        # Maps each origin ICAO to its nearby airports, None for unknown origins like get_closest_airports
+        known = [icao for icao in pd.unique(np.asarray(icaos)) if icao in self.airport_grid]
+        closest = dict.fromkeys(icaos)
+        for icao, rows in zip(known, self.airport_grid.icao_within_many(known, float(nm))):
+            closest[icao] = self.airports.iloc[rows]
+        return closest
+
+    def get_nearest_airports(self, icao, k):
+        if icao not in self.airport_grid:
+            return None
+        rows, distances = self.airport_grid.icao_nearest(icao, k)
+        nearest = self.airports.iloc[rows].copy()
+        nearest['Distance'] = distances
+        return nearest
 
     def get_distance(self, from_icao, to_icao):
-        lat1, lon1 = [radians(x) for x in
-                      self.all_airports[self.all_airports.icao == from_icao][['lat', 'lon']].iloc[0]]
-        lat2, lon2 = [radians(x) for x in self.all_airports[self.all_airports.icao == to_icao][['lat', 'lon']].iloc[0]]
-        return common.get_distance(lat1, lon1, lat2, lon2)
+        distance = self.memo.distances.get((from_icao, to_icao))
+        if distance is MISSING:
+            with stats.timer('distance'):
+                distance = self.airport_index.distance(from_icao, to_icao)
+            self.memo.distances.put((from_icao, to_icao), distance)
+        return distance
+
+    def get_distances(self, from_icaos, to_icaos):
+        with stats.timer('distance'):
+            return self.airport_index.distances(from_icaos, to_icaos)
+
+    def stream_frames(self, links, parse):
+        # Each response is parsed off the socket and normalized as soon as it arrives
+        for frame in self.fetcher.map(links, fetch=self.fetcher.get_frame):
+            yield parse(frame)
+
+    def parse_jobs(self, frame):
+        with stats.timer('parse'):
+            return schema.assignments(common.cast_assignments(schema.normalize_columns(frame)), self.icao_dtype)
+
+    def parse_aircraft_locations(self, frame):
+        with stats.timer('parse'):
+            return schema.aircraft_locations(frame, self.icao_dtype)
+
+    @staticmethod
+    def concat(frames):
+        frames = list(frames)
+        # Empty replies carry no dtypes and would turn the concatenated columns into object
+        non_empty = [frame for frame in frames if len(frame)]
+        if non_empty:
+            return pd.concat(non_empty)
+        return frames[0] if frames else pd.DataFrame()
+
+    def get_jobs_from_link(self, icaos):
+        return self.link + 'query=icao&search=jobsfrom&icaos={}'.format('-'.join(icaos))
+
+    def get_airports_for_link(self, makeModel):
+        return self.link + 'query=aircraft&search=makemodel&makemodel={}'.format(quote(makeModel.encode("utf-8")))
 
     def get_jobs_from(self, icaos):
-        return common.retry(self.get_query, const.LINK + 'query=icao&search=jobsfrom&icaos={}'.format('-'.join(icaos)),
-                            error_type=TooManyConnectionsException)
+        return self.get_query(self.get_jobs_from_link(icaos))
 
     def get_aircraft(self):
-        return common.retry(self.get_query, const.LINK + 'query=aircraft&search=configs',
-                            error_type=TooManyConnectionsException)
+        return self.get_query(self.link + 'query=aircraft&search=configs')
 
     def get_airports_for(self, makeModel):
-        print('Searching for the airports with aircraft {}'.format(makeModel))
-        return common.retry(self.get_query,
-                            const.LINK + 'query=aircraft&search=makemodel&makemodel={}'.format(
-                                quote(makeModel.encode("utf-8"))),
-                            error_type=TooManyConnectionsException)
+        log.debug('Searching for the airports with aircraft %s', makeModel)
+        return self.get_query(self.get_airports_for_link(makeModel))
 
     def get_query(self, query_link):
-        if self.service_key:
-            query_link += '&servicekey={}'.format(self.service_key)
-        elif self.user_key:
-            query_link += '&userkey={}'.format(self.user_key)
-        while time.time() - self.last_request_time < 7:
-            time.sleep(1)
-        resource = urlopen(query_link)
-        result = resource.read().decode(resource.headers.get_content_charset())
-        self.last_request_time = time.time()
-        if 'many requests in 60 second period' in result:
-            print('Too many requests error. Use sevice key to avoid this error.')
-            raise TooManyConnectionsException(result)
-        if 'request was under the minimum delay' in result:
-            raise TooManyConnectionsException(result)
-        if 'Currently Closed for Maintenance' in result:
-            raise ServerUnreachableException(result)
-        return result
+        return self.fetcher.get(query_link)
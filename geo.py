@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS = 6371000
+METERS_PER_NM = 1850
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Same formula as common.get_distance, broadcast over NumPy arrays (radians in, nm out)
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return np.round((EARTH_RADIUS * c) / METERS_PER_NM, 1)
+
+
+class AirportIndex(object):
+    def __init__(self, airports):
+        self.icaos = np.asarray(airports.icao.astype(str))
+        self.rows = {icao: i for i, icao in enumerate(self.icaos)}
+        self.lat = np.radians(airports.lat.to_numpy(dtype=float))
+        self.lon = np.radians(airports.lon.to_numpy(dtype=float))
+        # Shared categorical ICAO codes (see schema.icao_dtype) resolve to rows without a dict lookup
+        self.icao_dtype = airports.icao.dtype if isinstance(airports.icao.dtype, pd.CategoricalDtype) else None
+        if self.icao_dtype is not None:
+            self.code_rows = np.full(len(self.icao_dtype.categories), -1, dtype=np.intp)
+            self.code_rows[airports.icao.cat.codes.to_numpy()] = np.arange(len(airports))
+
+    def __contains__(self, icao):
+        return icao in self.rows
+
+    def __len__(self):
+        return len(self.icaos)
+
+    def row(self, icao):
+        return self.rows[icao]
+
+    def rows_for(self, icaos):
+        if self.icao_dtype is not None and getattr(icaos, 'dtype', None) == self.icao_dtype:
+            return self.rows_for_codes(pd.Series(icaos).cat.codes.to_numpy())
+        if pd.api.types.is_integer_dtype(getattr(icaos, 'dtype', None)):
+            return self.rows_for_codes(icaos)
+        return np.fromiter((self.rows[icao] for icao in icaos), dtype=np.intp)
+
+    def rows_for_codes(self, codes):
+        codes = np.asarray(codes)
+        rows = self.code_rows[codes]
+        if (codes < 0).any() or (rows < 0).any():
+            raise KeyError('ICAO codes not in this index')
+        return rows
+
+    def distance(self, from_icao, to_icao):
+        i = self.rows[from_icao]
+        j = self.rows[to_icao]
+        return float(haversine(self.lat[i], self.lon[i], self.lat[j], self.lon[j]))
+
+    def distances_from(self, from_icao, to_icaos=None):
+        i = self.rows[from_icao]
+        if to_icaos is None:
+            return haversine(self.lat[i], self.lon[i], self.lat, self.lon)
+        j = self.rows_for(to_icaos)
+        return haversine(self.lat[i], self.lon[i], self.lat[j], self.lon[j])
+
+    def distances(self, from_icaos, to_icaos):
+        i = self.rows_for(from_icaos)
+        j = self.rows_for(to_icaos)
+        return self.distances_between_rows(i, j)
+
+    def distances_between_rows(self, i, j):
+        # Element-wise distances for two aligned row arrays
+        return haversine(self.lat[i], self.lon[i], self.lat[j], self.lon[j])
+
+    def distance_matrix(self, from_icaos, to_icaos=None):
+        i = self.rows_for(from_icaos)
+        j = i if to_icaos is None else self.rows_for(to_icaos)
+        return haversine(self.lat[i][:, None], self.lon[i][:, None], self.lat[j][None, :], self.lon[j][None, :])
+
+
+class AirportGrid(AirportIndex):
+    # Bucket airports into lat/lon cells so radius queries only look at nearby cells
+    def __init__(self, airports, cell_size=1.0):
+        super(AirportGrid, self).__init__(airports)
+        self.cell_size = cell_size
+        self.n_rows = int(np.ceil(180 / cell_size))
+        self.n_cols = int(np.ceil(360 / cell_size))
+        cells = self._cell_row(self.lat) * self.n_cols + self._cell_col(self.lon)
+        self.order = np.argsort(cells, kind='stable')
+        self.offsets = np.searchsorted(cells[self.order], np.arange(self.n_rows * self.n_cols + 1))
+
+    def _cell_row(self, lat):
+        rows = np.floor((np.degrees(lat) + 90) / self.cell_size).astype(np.intp)
+        return np.clip(rows, 0, self.n_rows - 1)
+
+    def _cell_col(self, lon):
+        return np.floor((np.degrees(lon) + 180) / self.cell_size).astype(np.intp) % self.n_cols
+
+    def _candidates(self, lat, lon, nm):
+        # Angular radius with a small margin for the 0.1 nm rounding of haversine
+        r = (nm + 0.1) * METERS_PER_NM / EARTH_RADIUS
+        row_min = int(self._cell_row(lat - r))
+        row_max = int(self._cell_row(lat + r))
+        if lat + r >= np.pi / 2 or lat - r <= -np.pi / 2 or np.sin(r) >= np.cos(lat):
+            col_ranges = [(0, self.n_cols - 1)]
+        else:
+            dlon = np.arcsin(np.sin(r) / np.cos(lat))
+            col_min = int(self._cell_col(lon - dlon))
+            col_max = int(self._cell_col(lon + dlon))
+            if col_min <= col_max:
+                col_ranges = [(col_min, col_max)]
+            else:
+                # Longitude wraps around the antimeridian
+                col_ranges = [(col_min, self.n_cols - 1), (0, col_max)]
+        chunks = []
+        for row in range(row_min, row_max + 1):
+            for col_min, col_max in col_ranges:
+                start = self.offsets[row * self.n_cols + col_min]
+                end = self.offsets[row * self.n_cols + col_max + 1]
+                if end > start:
+                    chunks.append(self.order[start:end])
+        if not chunks:
+            return np.empty(0, dtype=np.intp)
+        return np.concatenate(chunks)
+
+    def within(self, lat, lon, nm):
+        candidates = self._candidates(lat, lon, nm)
+        distances = haversine(lat, lon, self.lat[candidates], self.lon[candidates])
+        return np.sort(candidates[distances < nm])
+
+    def within_many(self, lats, lons, nm):
+        return [self.within(lat, lon, nm) for lat, lon in zip(lats, lons)]
+
+    def nearest(self, lat, lon, k, nm=50.0):
+        k = min(k, len(self))
+        if not k:
+            return np.empty(0, dtype=np.intp), np.empty(0)
+        # Grow the search radius until at least k airports are inside it
+        max_nm = np.pi * EARTH_RADIUS / METERS_PER_NM
+        while True:
+            candidates = self._candidates(lat, lon, nm)
+            distances = haversine(lat, lon, self.lat[candidates], self.lon[candidates])
+            if (distances < nm).sum() >= k or nm > max_nm:
+                order = np.argsort(distances, kind='stable')[:k]
+                return candidates[order], distances[order]
+            nm *= 2
+
+    def icao_within(self, icao, nm):
+        i = self.rows[icao]
+        return self.within(self.lat[i], self.lon[i], nm)
+
+    def icao_within_many(self, icaos, nm):
+        rows = self.rows_for(icaos)
+        return self.within_many(self.lat[rows], self.lon[rows], nm)
+
+    def icao_nearest(self, icao, k, nm=50.0):
+        i = self.rows[icao]
+        return self.nearest(self.lat[i], self.lon[i], k, nm)
@@ -0,0 +1,66 @@
+import contextlib
+import json
+import threading
+import time
+from collections import defaultdict
+
+
+class Stats(object):
+    # Accumulated wall time and call count per stage plus free-form counters. Cheap enough to stay on in
+    # the hot loops; fetch threads share one instance, hence the lock. Stages timed on several threads or
+    # worker processes add up their time, so together they can exceed the total.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.seconds = defaultdict(float)
+            self.calls = defaultdict(int)
+            self.counters = defaultdict(int)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.seconds[name] += elapsed
+                self.calls[name] += 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def merge(self, other):
+        # other is an as_dict() result, e.g. from a worker process
+        with self.lock:
+            for name, stage in other['stages'].items():
+                self.seconds[name] += stage['seconds']
+                self.calls[name] += stage['calls']
+            for name, value in other['counters'].items():
+                self.counters[name] += value
+
+    def as_dict(self):
+        with self.lock:
+            return {'stages': {name: {'seconds': round(self.seconds[name], 6), 'calls': self.calls[name]}
+                               for name in self.seconds},
+                    'counters': dict(self.counters)}
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def report(self):
+        data = self.as_dict()
+        lines = ['{:<12}{:>12}{:>10}'.format('stage', 'seconds', 'calls')]
+        for name, stage in sorted(data['stages'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append('{:<12}{:>12.3f}{:>10}'.format(name, stage['seconds'], stage['calls']))
+        if data['counters']:
+            lines.append('')
+            lines.extend('{:<32}{:>10}'.format(name, value) for name, value in sorted(data['counters'].items()))
+        return '\n'.join(lines)
+
+
+stats = Stats()
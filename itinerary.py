@@ -0,0 +1,208 @@
+import heapq
+import itertools
+
+import numpy as np
+import pandas as pd
+
+import common
+import const
+import knapsack
+from instrument import stats
+
+ITINERARY_COLUMNS = ['Legs', 'Route', 'Amount', 'Pay', 'Assignments', 'MakeModel', 'Registration', 'Location',
+                     'CruiseSpeed', 'RentalDry', 'RentalWet', 'CraftDistance', 'Distance', 'FlightHours', 'DryRent',
+                     'WetRent', 'DryEarnings', 'WetEarnings', 'DryRatio', 'WetRatio']
+
+
+class Itinerary(object):
+    def __init__(self, legs, icao, distance, pay, amounts, assignments):
+        self.legs = legs
+        self.icao = icao
+        # Distance includes the ferry flight to the first origin, pay is already net of the PT share
+        self.distance = distance
+        self.pay = pay
+        self.amounts = amounts
+        self.assignments = assignments
+
+
+class ItineraryPlanner(object):
+    # Airports are nodes and every FromIcao -> ToIcao pair with jobs is an edge. An edge's weight for an
+    # aircraft is the knapsack-optimal pay for the payload that aircraft can carry over that distance;
+    # those knapsacks are memoized per (edge, capacity), so aircraft of one model share them.
+    def __init__(self, fse, max_legs=4, min_legs=2, beam_width=50, rank_by='DryEarnings'):
+        self.fse = fse
+        self.max_legs = max_legs
+        self.min_legs = min_legs
+        self.beam_width = beam_width
+        self.rank_by = rank_by
+        self.leg_cache = {}
+        self.jobs = {}
+        self.pay = fse.assignment_index.frame.Pay.to_numpy()
+        self.edges = self.build_edges(fse.get_aggregated_assignments())
+
+    def build_edges(self, routes):
+        # One edge per airport pair; both unit types share one knapsack. Pay is the sum over all jobs of the
+        # pair, an upper bound for any aircraft, and orders each origin's edges best first.
+        icaos = self.fse.airport_index.icaos
+        routes = routes[(routes.FromIcao.astype(str).isin(icaos) & routes.ToIcao.astype(str).isin(icaos)).to_numpy()]
+        pay = routes.groupby(['FromIcao', 'ToIcao'], observed=True).Pay.transform('sum')
+        routes = routes.assign(Pay=pay).sort_values('Pay', ascending=False, kind='stable')
+        routes = routes.drop_duplicates(['FromIcao', 'ToIcao'])
+        distance = self.fse.get_distances(routes.FromIcao, routes.ToIcao)
+        pt_share = np.where(routes.PtAssignment > 6, routes.PtAssignment / 100, 0)
+        edges = {}
+        for from_icao, rows in pd.DataFrame({
+                'FromIcao': routes.FromIcao.astype(str).to_numpy(), 'ToIcao': routes.ToIcao.astype(str).to_numpy(),
+                'Distance': np.asarray(distance, dtype=float), 'PtShare': pt_share,
+                'Pay': routes.Pay.to_numpy(dtype=float)}).groupby('FromIcao', sort=False):
+            edges[from_icao] = (rows.ToIcao.to_numpy(), rows.Distance.to_numpy(), rows.PtShare.to_numpy(),
+                                rows.Pay.to_numpy())
+        return edges
+
+    def get_jobs(self, from_icao, to_icao, vip):
+        # The jobs of an edge as arrays in their original order, read once from the index's slices and
+        # shared by every capacity
+        key = (from_icao, to_icao, vip)
+        if key not in self.jobs:
+            index = self.fse.assignment_index
+            groups = index.slices.get((from_icao, to_icao), {})
+            rows, is_passengers = [np.empty(0, dtype=int)], [np.empty(0, dtype=bool)]
+            for unit_type in ('passengers', 'kg'):
+                if (vip, unit_type) in groups:
+                    rows.append(np.arange(*groups[(vip, unit_type)]))
+                    is_passengers.append(np.full(len(rows[-1]), unit_type == 'passengers'))
+            rows, is_passengers = np.concatenate(rows), np.concatenate(is_passengers)
+            order = np.argsort(index.position[rows], kind='stable')
+            rows, is_passengers = rows[order], is_passengers[order]
+            self.jobs[key] = (self.pay[rows], index.amount[rows].astype(np.int64), is_passengers)
+        return self.jobs[key]
+
+    def get_leg(self, from_icao, to_icao, max_passengers, max_cargo, pt_share):
+        # Same selection as FSEconomy.get_best_assignments, straight on the arrays: the knapsack over the
+        # regular jobs that fit, unless a single VIP job pays at least as much
+        key = (from_icao, to_icao, max_passengers, max_cargo)
+        if key not in self.leg_cache:
+            pay, amount, is_passengers = self.get_jobs(from_icao, to_icao, False)
+            fits = amount <= np.where(is_passengers, max_passengers, max_cargo)
+            if not fits.any():
+                self.leg_cache[key] = None
+                return None
+            pay, amount, is_passengers = pay[fits], amount[fits], is_passengers[fits]
+            # Passenger jobs take seats and their weight, cargo jobs only weight
+            weight = np.where(is_passengers, amount * const.PAX_WEIGHT_KG, amount)
+            stats.count('knapsack.solved')
+            with stats.timer('knapsack'):
+                selected = knapsack.solve(pay, np.where(is_passengers, amount, 0), weight, max_passengers,
+                                          max_cargo, self.fse.solver)
+            best_pay, amounts = float(pay[selected].sum()), weight[selected].tolist()
+
+            vip_pay, vip_amount, vip_is_passengers = self.get_jobs(from_icao, to_icao, True)
+            vip_fits = np.flatnonzero(vip_amount <= np.where(vip_is_passengers, max_passengers, max_cargo))
+            if len(vip_fits):
+                best = vip_fits[np.argmax(vip_pay[vip_fits])]
+                if vip_pay[best] >= best_pay:
+                    best_pay, amounts = float(vip_pay[best]), [int(vip_amount[best])]
+
+            if not amounts:
+                self.leg_cache[key] = None
+            else:
+                self.leg_cache[key] = (best_pay - best_pay * pt_share, int(sum(amounts)), amounts)
+        return self.leg_cache[key]
+
+    def plan(self, aircraft, start_icao):
+        # Beam search over chains of legs starting at start_icao. Every leg has to be in range and within
+        # the rental time on its own, the whole chain including the ferry flight has to fit the rental time.
+        # States are ranked by pay minus rent so far.
+        rate = aircraft[const.RENT_COLUMNS[self.rank_by]] / aircraft['CruiseSpeed']
+        if not rate > 0:
+            return []
+        max_distance = aircraft['RentalTime'] / 3600 * aircraft['CruiseSpeed']
+        ferry = self.fse.get_distance(aircraft['Location'], start_icao)
+        beam = [Itinerary((), start_icao, ferry, 0.0, (), ())]
+        finished = []
+        for depth in range(self.max_legs):
+            expanded = []
+            for state in beam:
+                expanded.extend(self.expand(state, aircraft, rate, max_distance))
+            beam = heapq.nlargest(self.beam_width, expanded, key=lambda s: s.pay - s.distance * rate)
+            if depth + 1 >= self.min_legs:
+                finished.extend(beam)
+            if not beam:
+                break
+        return finished
+
+    def expand(self, state, aircraft, rate, max_distance):
+        if state.icao not in self.edges:
+            return []
+        to_icaos, distances, pt_shares, pays = self.edges[state.icao]
+        fuel_needed, seconds_needed, _, max_cargo, max_passengers = common.get_leg_limits(distances, aircraft)
+        # Legs whose pay cannot even cover their own rent are left out of the chain
+        usable = ((fuel_needed <= aircraft['MaxFuel']) & (seconds_needed <= aircraft['RentalTime']) &
+                  (state.distance + distances <= max_distance) & (pays - distances * rate > 0))
+        flown = set(state.legs)
+        expanded = []
+        # Edges are in descending order of their pay bound, so the first beam_width usable ones are enough
+        # to fill this state's share of the next beam
+        for i in np.flatnonzero(usable):
+            if len(expanded) >= self.beam_width:
+                break
+            leg = (state.icao, to_icaos[i])
+            if leg in flown:
+                continue
+            solved = self.get_leg(state.icao, to_icaos[i], int(max_passengers[i]), int(max_cargo[i]), pt_shares[i])
+            if solved is None:
+                continue
+            pay, amount, assignments = solved
+            expanded.append(Itinerary(state.legs + (leg,), to_icaos[i], state.distance + distances[i],
+                                      state.pay + pay, state.amounts + (amount,), state.assignments + (assignments,)))
+        return expanded
+
+    def to_frame(self, itineraries):
+        rows = []
+        for aircraft, itinerary in itineraries:
+            route = [itinerary.legs[0][0]] + [to_icao for _, to_icao in itinerary.legs]
+            craft_distance = self.fse.get_distance(aircraft['Location'], route[0])
+            rows.append({'Legs': len(itinerary.legs), 'Route': '>'.join(route), 'Amount': sum(itinerary.amounts),
+                         'Pay': round(itinerary.pay, 2), 'Assignments': str(list(itinerary.assignments)),
+                         'MakeModel': aircraft['MakeModel'], 'Registration': aircraft['Registration'],
+                         'Location': aircraft['Location'], 'CruiseSpeed': aircraft['CruiseSpeed'],
+                         'RentalDry': aircraft['RentalDry'], 'RentalWet': aircraft['RentalWet'],
+                         'CraftDistance': craft_distance, 'Distance': round(itinerary.distance - craft_distance, 1),
+                         'FlightHours': round(itinerary.distance / aircraft['CruiseSpeed'], 1),
+                         'PtAssignment': 0})
+        frame = pd.DataFrame(rows, columns=ITINERARY_COLUMNS[:ITINERARY_COLUMNS.index('DryRent')] + ['PtAssignment'])
+        flown = frame.Distance + frame.CraftDistance
+        frame['DryRent'] = np.round(flown * frame.RentalDry / frame.CruiseSpeed, 2)
+        frame['WetRent'] = np.round(flown * frame.RentalWet / frame.CruiseSpeed, 2)
+        # Pay is already net of the PT share, hence the zero PtAssignment
+        frame['DryEarnings'] = common.get_earnings_columns(frame, 'DryRent')
+        frame['WetEarnings'] = common.get_earnings_columns(frame, 'WetRent')
+        frame['DryRatio'] = common.get_ratio_columns(frame, 'DryEarnings')
+        frame['WetRatio'] = common.get_ratio_columns(frame, 'WetEarnings')
+        return frame[ITINERARY_COLUMNS]
+
+
+@stats.timer('plan')
+def plan_itineraries(fse, origins, radius, top, max_legs=4, beam_width=50, rank_by='DryEarnings',
+                     min_earnings=0):
+    # Plans from each origin with every rentable aircraft within radius and keeps the top best itineraries
+    planner = ItineraryPlanner(fse, max_legs=max_legs, beam_width=beam_width, rank_by=rank_by)
+    rate_column = const.RENT_COLUMNS[rank_by]
+    closest_airports = fse.get_closest_airports_many(origins, radius)
+    heap = []
+    sequence = itertools.count()
+    for origin in origins:
+        close_aircraft = fse.get_close_aircraft_frame(origin, radius, closest_airports[origin])
+        if close_aircraft is None:
+            continue
+        for _, aircraft in close_aircraft.iterrows():
+            rate = aircraft[rate_column] / aircraft['CruiseSpeed']
+            for itinerary in planner.plan(aircraft, origin):
+                item = (itinerary.pay - itinerary.distance * rate, next(sequence), (aircraft, itinerary))
+                if len(heap) < top:
+                    heapq.heappush(heap, item)
+                elif item[0] > heap[0][0]:
+                    heapq.heapreplace(heap, item)
+    frame = planner.to_frame([value for _, _, value in sorted(heap, key=lambda item: item[1])])
+    frame = frame[(frame.DryEarnings >= min_earnings) | (frame.WetEarnings >= min_earnings)]
+    return frame.sort_values(rank_by, ascending=False, kind='stable').reset_index(drop=True)
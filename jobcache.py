@@ -0,0 +1,48 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+import common
+import const
+import store
+
+
+class JobCache(object):
+    # Jobs per departure airport with the time they were fetched, persisted between runs
+    def __init__(self, path=const.JOB_CACHE_FILENAME, ttl=const.JOB_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.jobs = pd.DataFrame()
+        self.fetched = {}
+        if path and store.snapshot_exists(path):
+            self.jobs = store.read_snapshot(path)
+            self.fetched = store.read_extra(path)['fetched']
+
+    def expired(self, icaos, now=None):
+        # Missing airports first, then stale ones in descending order of the pay they had last time
+        now = time.time() if now is None else now
+        missing = [icao for icao in icaos if icao not in self.fetched]
+        stale = [icao for icao in icaos if icao in self.fetched and now - self.fetched[icao] >= self.ttl]
+        if stale and len(self.jobs):
+            pay = self.jobs.groupby('FromIcao').Pay.sum()
+            stale.sort(key=lambda icao: -pay.get(icao, 0))
+        return missing + stale
+
+    def update(self, icaos, jobs, now=None):
+        now = time.time() if now is None else now
+        icaos = list(icaos)
+        kept = self.jobs[~self.jobs.FromIcao.isin(icaos)] if len(self.jobs) else self.jobs
+        self.jobs = pd.concat([kept, jobs]) if len(kept) else jobs
+        self.fetched.update(dict.fromkeys(icaos, now))
+
+    def get(self, icaos):
+        if not len(self.jobs):
+            return self.jobs
+        return self.jobs[self.jobs.FromIcao.isin(np.asarray(icaos))]
+
+    def save(self):
+        if len(self.jobs):
+            self.jobs = common.cast_assignments(self.jobs)
+        store.write_snapshot(self.path, self.jobs, partition_by='FromIcao' if len(self.jobs) else None,
+                             extra={'fetched': self.fetched})
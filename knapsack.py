@@ -0,0 +1,137 @@
+import numpy as np
+
+# Largest DP table (items x passenger capacity x weight capacity) solved in process
+DP_MAX_CELLS = 2 * 10 ** 7
+# Branch and bound gives up and hands over to PuLP after this many nodes
+BB_MAX_NODES = 200000
+
+
+def solve_dp(pay, passengers, weight, max_passengers, max_weight):
+    # Exact 0/1 knapsack over integer (passengers, weight) capacities
+    n = len(pay)
+    if not n:
+        return []
+    if not _is_integral(passengers) or not _is_integral(weight):
+        return None
+    passengers = np.asarray(passengers, dtype=np.int64)
+    weight = np.asarray(weight, dtype=np.int64)
+    max_passengers = int(min(max_passengers, passengers.sum()))
+    max_weight = int(min(max_weight, weight.sum()))
+    if (max_passengers + 1) * (max_weight + 1) * n > DP_MAX_CELLS:
+        return None
+
+    best = np.zeros((max_passengers + 1, max_weight + 1), dtype=np.asarray(pay).dtype)
+    taken = np.zeros((n, max_passengers + 1, max_weight + 1), dtype=bool)
+    for i in range(n):
+        p, w, v = passengers[i], weight[i], pay[i]
+        if p > max_passengers or w > max_weight or v <= 0:
+            continue
+        candidate = best[:max_passengers + 1 - p, :max_weight + 1 - w] + v
+        improved = candidate > best[p:, w:]
+        taken[i, p:, w:] = improved
+        best[p:, w:] = np.where(improved, candidate, best[p:, w:])
+
+    selected = []
+    p, w = max_passengers, max_weight
+    for i in range(n - 1, -1, -1):
+        if taken[i, p, w]:
+            selected.append(i)
+            p -= passengers[i]
+            w -= weight[i]
+    return sorted(selected)
+
+
+def solve_branch_and_bound(pay, passengers, weight, max_passengers, max_weight, max_nodes=BB_MAX_NODES):
+    # Depth-first branch and bound; the bound is the tighter of the two single-constraint LP relaxations
+    pay = np.asarray(pay, dtype=float)
+    passengers = np.asarray(passengers, dtype=float)
+    weight = np.asarray(weight, dtype=float)
+    usable = np.flatnonzero((pay > 0) & (passengers <= max_passengers) & (weight <= max_weight))
+    if not len(usable):
+        return []
+    # Branch on items with the best pay per unit of combined normalized capacity first
+    usage = passengers[usable] / max(max_passengers, 1) + weight[usable] / max(max_weight, 1)
+    usable = usable[np.argsort(-pay[usable] / np.maximum(usage, 1e-9), kind='stable')]
+    pay, passengers, weight = pay[usable], passengers[usable], weight[usable]
+    by_passengers = np.argsort(-pay / np.maximum(passengers, 1e-9), kind='stable')
+    by_weight = np.argsort(-pay / np.maximum(weight, 1e-9), kind='stable')
+    n = len(usable)
+
+    def relaxation(order, sizes, capacity, start, value):
+        for i in order:
+            if i < start:
+                continue
+            if sizes[i] <= capacity:
+                capacity -= sizes[i]
+                value += pay[i]
+            else:
+                return value + pay[i] * capacity / sizes[i]
+        return value
+
+    def bound(start, pax_left, weight_left, value):
+        return min(relaxation(by_passengers, passengers, pax_left, start, value),
+                   relaxation(by_weight, weight, weight_left, start, value))
+
+    best_value = 0.0
+    best_items = []
+    nodes = 0
+    stack = [(0, max_passengers, max_weight, 0.0, [])]
+    while stack:
+        nodes += 1
+        if nodes > max_nodes:
+            return None
+        start, pax_left, weight_left, value, items = stack.pop()
+        if value > best_value:
+            best_value, best_items = value, items
+        if start == n or bound(start, pax_left, weight_left, value) <= best_value:
+            continue
+        # Push the exclude branch first so the include branch is explored first
+        stack.append((start + 1, pax_left, weight_left, value, items))
+        if passengers[start] <= pax_left and weight[start] <= weight_left:
+            stack.append((start + 1, pax_left - passengers[start], weight_left - weight[start], value + pay[start],
+                          items + [start]))
+    return sorted(int(usable[i]) for i in best_items)
+
+
+def solve_pulp(pay, passengers, weight, max_passengers, max_weight):
+    from pulp import LpMaximize, LpProblem, LpVariable
+
+    prob = LpProblem("KnapsackProblem", LpMaximize)
+    x_list = [LpVariable('x{}'.format(i), 0, 1, 'Integer') for i in range(1, 1 + len(weight))]
+    prob += sum([x * p for x, p in zip(x_list, pay)]), 'obj'
+    prob += sum([x * w for x, w in zip(x_list, passengers)]) <= max_passengers, 'c1'
+    prob += sum([x * w for x, w in zip(x_list, weight)]) <= max_weight, 'c2'
+    prob.solve()
+    return [i for i in range(len(x_list)) if x_list[i].varValue]
+
+
+SOLVERS = {
+    'auto': (solve_dp, solve_branch_and_bound, solve_pulp),
+    'dp': (solve_dp, solve_pulp),
+    'bb': (solve_branch_and_bound, solve_pulp),
+    'pulp': (solve_pulp,),
+}
+
+
+def solve(pay, passengers, weight, max_passengers, max_weight, solver='auto'):
+    # Returns the positions of the chosen items. Engines answer None when the instance is too big for them
+    # and the next one in line takes over; PuLP/CBC is always the last resort.
+    if max_passengers < 0 or max_weight < 0:
+        return []
+    pay = np.asarray(pay)
+    passengers = np.asarray(passengers)
+    weight = np.asarray(weight)
+    fits = (passengers <= max_passengers) & (weight <= max_weight)
+    if passengers[fits].sum() <= max_passengers and weight[fits].sum() <= max_weight:
+        return [int(i) for i in np.flatnonzero(fits & (pay > 0))]
+    for engine in SOLVERS[solver]:
+        if engine is solve_pulp:
+            return solve_pulp(pay.tolist(), passengers.tolist(), weight.tolist(), max_passengers, max_weight)
+        selected = engine(pay, passengers, weight, max_passengers, max_weight)
+        if selected is not None:
+            return selected
+
+
+def _is_integral(values):
+    values = np.asarray(values)
+    return values.dtype.kind in 'iub' or bool(np.all(np.mod(values, 1) == 0))
@@ -1,29 +1,263 @@
 import argparse
+import heapq
+import itertools
+import logging
+import numpy as np
 import pandas as pd
 
 # import modin.pandas as pd
 
 import const
 from fseconomy import FSEconomy
+from instrument import stats
+from jobcache import JobCache
+from memo import Memo
 import common
-from math import floor
+import itinerary
+import knapsack
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 
-def do_work(args):
-    fse = FSEconomy(args.local, args.skey, args.ukey)
+log = logging.getLogger(__name__)
+
+RESULT_COLUMNS = ['FromIcao', 'ToIcao', 'Amount', 'Pay', 'Assignments', 'MakeModel', 'Registration', 'Location',
+                  'Seats', 'MTOW', 'CruiseSpeed', 'RentalDry', 'RentalWet', 'CraftDistance', 'Distance', 'PayloadNow',
+                  'AircraftFuelForTripGal', 'MaxCargo', 'MaxPassengers', 'DryRent', 'WetRent', 'DryEarnings',
+                  'WetEarnings', 'DryRatio', 'WetRatio']
+ROUTE_COLUMNS = ['FromIcao', 'ToIcao', 'PtAssignment']
+AIRCRAFT_COLUMNS = ['MakeModel', 'Registration', 'Location', 'Seats', 'MTOW', 'CruiseSpeed', 'RentalDry', 'RentalWet',
+                    'RentalTime', 'PctFuel', 'GPH', 'MaxFuel', 'BasePayload', 'FullFuelPayload', 'PassengerSeats']
+# Routes evaluated together; the --limit check happens between routes, so this only bounds wasted work
+ROUTE_BATCH = 32
+
+
+@stats.timer('filter')
+def build_candidates(fse, routes, radius, offset=0, route_columns=ROUTE_COLUMNS):
+    # One row per route and nearby aircraft, in route order and then airport order. An unknown origin
+    # ends the search like it always has, so complete tells the caller whether to go on.
+    closest_airports = fse.get_closest_airports_many(routes.FromIcao, radius)
+    positions = []
+    aircraft = []
+    complete = True
+    for position, from_icao in enumerate(routes.FromIcao):
+        close_aircraft = fse.get_close_aircraft_frame(from_icao, radius, closest_airports[from_icao])
+        if close_aircraft is None:
+            complete = False
+            break
+        positions.extend([position] * len(close_aircraft))
+        aircraft.append(close_aircraft[AIRCRAFT_COLUMNS])
+
+    candidates = routes.iloc[positions][route_columns].reset_index(drop=True)
+    candidates['RouteOrder'] = np.asarray(positions, dtype=int) + offset
+    if not positions:
+        return candidates.reindex(columns=list(candidates.columns) + AIRCRAFT_COLUMNS), complete
+    aircraft = pd.concat(aircraft, ignore_index=True)
+    return pd.concat([candidates, aircraft], axis=1), complete
+
+
+def evaluate_candidates(fse, candidates, min_earnings):
+    # Fuel, payload and rent maths run on whole columns; only the knapsack is solved row by row
+    c = candidates.copy()
+    c['Distance'] = fse.get_distances(c.FromIcao, c.ToIcao)
+    stats.count('candidates', len(c))
+    with stats.timer('filter'):
+        c['PayloadNow'] = np.round(c.BasePayload - np.round(c.MaxFuel * c.PctFuel) * const.GALLONS_TO_KG)
+        fuel_needed, seconds_needed, fuel_for_trip, max_cargo, max_passengers = common.get_leg_limits(c.Distance, c)
+        feasible = ((fuel_needed <= c.MaxFuel) & (c.RentalTime >= seconds_needed)).to_numpy()
+        c = c[feasible].copy()
+        c['AircraftFuelForTripGal'] = fuel_for_trip[feasible]
+        c['MaxCargo'] = max_cargo[feasible].astype(int)
+        c['MaxPassengers'] = max_passengers[feasible].astype(int)
+
+    # select covers the whole per-row job selection, the knapsack stage only the solver inside it
+    solved = []
+    with stats.timer('select'):
+        for from_icao, to_icao, max_passengers, max_cargo in zip(c.FromIcao, c.ToIcao, c.MaxPassengers,
+                                                                 c.MaxCargo):
+            best_assignments = fse.get_best_assignments({'FromIcao': from_icao, 'ToIcao': to_icao,
+                                                         'MaxPassengers': int(max_passengers),
+                                                         'MaxCargo': int(max_cargo)})
+            if best_assignments is None:
+                solved.append(None)
+            else:
+                solved.append((sum(best_assignments['Amount']), sum(best_assignments['Pay']),
+                               str(best_assignments['Amount'].tolist())))
+    found = np.array([s is not None for s in solved], dtype=bool)
+    c = c[found].copy()
+    craft_distance = fse.get_distances(c.FromIcao, c.Location)
+
+    with stats.timer('assembly'):
+        solved = [s for s in solved if s is not None]
+        c['Amount'] = [s[0] for s in solved]
+        c['Pay'] = [s[1] for s in solved]
+        c['Assignments'] = [s[2] for s in solved]
+
+        c['CraftDistance'] = craft_distance
+        c['DryRent'] = np.round((c.Distance + c.CraftDistance) * c.RentalDry / c.CruiseSpeed, 2)
+        c['WetRent'] = np.round((c.Distance + c.CraftDistance) * c.RentalWet / c.CruiseSpeed, 2)
+        c['DryEarnings'] = common.get_earnings_columns(c, 'DryRent')
+        c['WetEarnings'] = common.get_earnings_columns(c, 'WetRent')
+        keep = ((c.DryEarnings + c.WetEarnings) != 0) & ~((c.DryEarnings < min_earnings) &
+                                                            (c.WetEarnings < min_earnings))
+        c = c[keep.to_numpy()].copy()
+        c['DryRatio'] = common.get_ratio_columns(c, 'DryEarnings')
+        c['WetRatio'] = common.get_ratio_columns(c, 'WetEarnings')
+    return c
 
-    for col in fse.assignments.columns:
-        if 'Unnamed' in col:
-            del fse.assignments[col]
 
-    aggregated = fse.get_aggregated_assignments()
+def take_until_limit(evaluated, remaining):
+    # Whole routes are taken while fewer than remaining rows came from the routes before them
+    routes = evaluated.RouteOrder.to_numpy()
+    before = np.searchsorted(routes, routes, side='left')
+    return evaluated[before < remaining]
+
+
+def evaluate_batch(fse, routes, offset, args):
+    candidates, complete = build_candidates(fse, routes, args.radius, offset)
+    return evaluate_candidates(fse, candidates, args.min), complete
+
+
+def evaluate_serial(fse, routes, args):
+    results = []
+    accepted = 0
+    for offset in range(0, len(routes), ROUTE_BATCH):
+        if accepted >= args.limit:
+            break
+        evaluated, complete = evaluate_batch(fse, routes.iloc[offset:offset + ROUTE_BATCH], offset, args)
+        evaluated = take_until_limit(evaluated, args.limit - accepted)
+        results.append(evaluated)
+        accepted += len(evaluated)
+        if not complete:
+            break
+    return results
+
+
+def get_route_bounds(fse, routes, rank_by):
+    # Optimistic earnings per route: every job between the two airports, flown by the aircraft with the
+    # cheapest rent per nm anywhere and no ferry leg
+    rent = const.RENT_COLUMNS[rank_by]
+    rentable = fse.rentable_aircraft
+    rates = (rentable[rent] / rentable.CruiseSpeed)[rentable[rent] > 0]
+    min_rate = rates.min() if len(rates) else 0
+    route_pay = routes.groupby(['FromIcao', 'ToIcao'], observed=True).Pay.transform('sum')
+    return route_pay - fse.get_distances(routes.FromIcao, routes.ToIcao) * min_rate, route_pay
+
+
+def evaluate_top_k(fse, routes, args):
+    # Best-first: routes in descending order of their bound, a heap of the best k results so far, and
+    # everything whose bound cannot beat the k-th result is skipped
+    rent = const.RENT_COLUMNS[args.rank_by]
+    routes = routes[routes.FromIcao.astype(str).isin(fse.airport_grid.icaos).to_numpy()]
+    bounds, route_pay = get_route_bounds(fse, routes, args.rank_by)
+    # Both unit types of a route share one knapsack, so the route is evaluated once
+    first = ~routes.duplicated(['FromIcao', 'ToIcao']).to_numpy()
+    routes, bounds, route_pay = routes[first], bounds[first], route_pay[first]
+    order = np.argsort(-bounds.to_numpy(), kind='stable')
+    routes = routes.iloc[order].assign(RoutePay=route_pay.to_numpy()[order])
+    bounds = bounds.to_numpy()[order]
+
+    heap = []
+    sequence = itertools.count()
+    for offset in range(0, len(routes), ROUTE_BATCH):
+        threshold = heap[0][0] if len(heap) >= args.top_k else -np.inf
+        batch = routes.iloc[offset:offset + ROUTE_BATCH][bounds[offset:offset + ROUTE_BATCH] > threshold]
+        if not len(batch):
+            break
+        candidates, _ = build_candidates(fse, batch, args.radius, offset, ROUTE_COLUMNS + ['RoutePay'])
+        # Same bound per candidate, now with its own rent and ferry distance; rents are rounded to cents
+        distance = fse.get_distances(candidates.FromIcao, candidates.ToIcao) + fse.get_distances(
+            candidates.FromIcao, candidates.Location)
+        candidate_bounds = candidates.RoutePay - distance * candidates[rent] / candidates.CruiseSpeed + 0.01
+        candidates = candidates[(candidate_bounds > threshold).to_numpy()]
+        for _, row in evaluate_candidates(fse, candidates, args.min).iterrows():
+            item = (row[args.rank_by], next(sequence), row)
+            if len(heap) < args.top_k:
+                heapq.heappush(heap, item)
+            elif item[0] > heap[0][0]:
+                heapq.heapreplace(heap, item)
+    return [pd.DataFrame([row for _, _, row in sorted(heap, key=lambda item: item[1])])] if heap else []
 
-    result = pd.DataFrame(
-        columns=['FromIcao', 'ToIcao', 'Amount', 'Pay', 'Assignments', 'MakeModel', 'Registration', 'Location', 'Seats',
-                 'MTOW',
-                 'CruiseSpeed', 'RentalDry', 'RentalWet', 'CraftDistance', 'Distance', 'PayloadNow',
-                 'AircraftFuelForTripGal', 'MaxCargo', 'MaxPassengers', 'DryRent', 'WetRent', 'DryEarnings',
-                 'WetEarnings', 'DryRatio', 'WetRatio'])
+
+_worker_fse = None
+
+
+def _init_worker(fse):
+    global _worker_fse
+    _worker_fse = fse
+
+
+def _evaluate_in_worker(routes, offset, args):
+    # The worker's timings travel back with each batch
+    stats.reset()
+    evaluated, complete = evaluate_batch(_worker_fse, routes, offset, args)
+    return evaluated, complete, stats.as_dict()
+
+
+def evaluate_parallel(fse, routes, args):
+    # Route batches are submitted a window ahead and consumed in order, so the output and the --limit
+    # cut-off are the same as evaluate_serial. The FSEconomy state reaches each worker once through the
+    # initializer.
+    offsets = iter(range(0, len(routes), ROUTE_BATCH))
+    pending = deque()
+    results = []
+    accepted = 0
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(fse,)) as executor:
+        while True:
+            for offset in itertools.islice(offsets, args.workers * 2 - len(pending)):
+                pending.append(executor.submit(_evaluate_in_worker, routes.iloc[offset:offset + ROUTE_BATCH],
+                                               offset, args))
+            if not pending or accepted >= args.limit:
+                break
+            evaluated, complete, worker_stats = pending.popleft().result()
+            stats.merge(worker_stats)
+            evaluated = take_until_limit(evaluated, args.limit - accepted)
+            results.append(evaluated)
+            accepted += len(evaluated)
+            if not complete:
+                break
+        executor.shutdown(cancel_futures=True)
+    return results
+
+
+def rank_routes(fse, routes, args):
+    # routes in the order they are searched; the result is sorted by DryEarnings, or by what the top K were
+    # chosen by
+    if args.top_k:
+        results = evaluate_top_k(fse, routes, args)
+    elif args.workers > 1:
+        results = evaluate_parallel(fse, routes, args)
+    else:
+        results = evaluate_serial(fse, routes, args)
+    with stats.timer('assembly'):
+        result = pd.concat(results, ignore_index=True)[RESULT_COLUMNS] if results else pd.DataFrame(
+            columns=RESULT_COLUMNS)
+        result = result.sort_values(args.rank_by if args.top_k else 'DryEarnings', ascending=False)
+    stats.count('results', len(result))
+    return result
+
+
+def save_memo(memo):
+    # Parallel workers fill their own copies, so the statistics and the saved memo only cover this process
+    memo.save()
+    log.info(memo.stats())
+    for name in ('distances', 'assignments'):
+        cache = getattr(memo, name)
+        stats.count('memo.{}.hits'.format(name), cache.hits)
+        stats.count('memo.{}.misses'.format(name), cache.misses)
+
+
+def do_work(args):
+    job_cache = JobCache(ttl=args.ttl * 60) if not args.local else None
+    memo = Memo(args.memo, args.memo_size)
+    fse = FSEconomy(args.local, args.skey, args.ukey, args.solver, job_cache=job_cache,
+                    refresh_limit=args.refresh_limit, memo=memo)
+    with stats.timer('load'):
+        # FSEconomy loads lazily; every search needs these, so load them here where they are timed
+        fse.assignment_index, fse.rentable_aircraft, fse.airport_grid
+
+    with stats.timer('aggregate'):
+        aggregated = fse.get_aggregated_assignments()
 
     # new_aggregated = aggregated[aggregated['FromIcao'].str.startswith('K')]
     # new_aggregated = new_aggregated.append(aggregated[aggregated['FromIcao'].str.startswith('E')])
@@ -31,88 +265,28 @@ def do_work(args):
 
     # new_aggregated = aggregated.sort_values('Pay', ascending=False)
 
-    index = 0
-    for _, row in new_aggregated.iterrows():
-        if index >= args.limit:
-            break
-        best_aircrafts = fse.get_close_aircraft(row['FromIcao'], args.radius)
+    if args.legs:
+        # Itineraries start at the origins of the best paying routes
+        origins = list(dict.fromkeys(new_aggregated.FromIcao.astype(str)))[:args.limit]
+        result = itinerary.plan_itineraries(fse, origins, args.radius, args.top_k or args.limit, args.legs,
+                                            args.beam, args.rank_by, args.min)
+        save_memo(memo)
+        print(result.to_string())
+        return
 
-        if best_aircrafts is None:
-            break
+    result = rank_routes(fse, new_aggregated, args)
+    with stats.timer('assembly'):
+        output = result.to_string()
 
-        for best_aircraft in best_aircrafts:
-            if best_aircraft is None:
-                continue
-            for column in ['MakeModel', 'Registration', 'Location', 'Seats', 'MTOW', 'CruiseSpeed', 'RentalDry',
-                           'RentalWet']:
-                row[column] = best_aircraft[column]
-            row['aircraft'] = best_aircraft
-            row['Distance'] = fse.get_distance(row['FromIcao'], row['ToIcao'])
-
-            additional_crew = row['aircraft']['Crew']
-            fuel_cap = common.get_max_fuel(row['aircraft'])
-            payload = int(row['aircraft']['MTOW']) - int(row['aircraft']['EmptyWeight']) - (
-                    const.PAX_WEIGHT_KG * (1 + additional_crew))
-            payload75 = round(payload - fuel_cap * const.GALLONS_TO_KG)
-            payload100 = round(payload - fuel_cap * const.GALLONS_TO_KG)
-            payloadnow = round(payload - common.get_total_fuel(row['aircraft']) * const.GALLONS_TO_KG)
-            row['PayloadNow'] = payloadnow
-            crewseats = 1
-            if additional_crew > 0:
-                crewseats = 2
-
-            seats = row['aircraft']['Seats'] - crewseats
-
-            estimated_fuel_needed = common.get_estimated_fuel_needed(row['Distance'], row['aircraft'])
-            if estimated_fuel_needed > fuel_cap:
-                continue
-            hours_needed = estimated_fuel_needed / row['aircraft']['GPH']
-            seconds_needed = hours_needed * 60 * 60
-            if row['aircraft']['RentalTime'] < seconds_needed:
-                continue
-
-            row['AircraftFuelForTripGal'] = max(common.get_estimated_fuel_needed(row['Distance'], row['aircraft']),
-                                                common.get_total_fuel(row['aircraft']))
-
-            percent = min(row['AircraftFuelForTripGal'] / fuel_cap * 100, 100)
-            max_payload = floor((100 - percent) * ((payload75 - payload100) / 25) + payload100)
-            max_pax = min(seats, floor(max_payload / const.PAX_WEIGHT_KG))
-
-            row['MaxCargo'] = max_payload
-            row['MaxPassengers'] = max_pax
-            best_assignments = fse.get_best_assignments(row)
-            if best_assignments is None:
-                continue
-            row['Amount'] = sum(best_assignments['Amount'])
-            row['Pay'] = sum(best_assignments['Pay'])
-            row['Assignments'] = str(best_assignments['Amount'].tolist())
-            row['CraftDistance'] = fse.get_distance(row['FromIcao'], row['aircraft']['Location'])
-            row['DryRent'] = round(
-                (row['Distance'] + row['CraftDistance']) * row['aircraft']['RentalDry'] / row['aircraft'][
-                    'CruiseSpeed'], 2)
-            row['WetRent'] = round(
-                (row['Distance'] + row['CraftDistance']) * row['aircraft']['RentalWet'] / row['aircraft'][
-                    'CruiseSpeed'], 2)
-            row['DryEarnings'] = common.get_earnings(row, 'DryRent')
-            row['WetEarnings'] = common.get_earnings(row, 'WetRent')
-            if not row['DryEarnings'] + row['WetEarnings']:
-                continue
-            if row['DryEarnings'] < args.min and row['WetEarnings'] < args.min:
-                continue
-
-            row['DryRatio'] = common.get_ratio(row, 'DryEarnings')
-            row['WetRatio'] = common.get_ratio(row, 'WetEarnings')
-            result.loc[index] = row
-            index += 1
-
-    print(result.sort_values('DryEarnings', ascending=False).to_string())
+    save_memo(memo)
+    print(output)
     if args.debug:
         import pdb
         pdb.set_trace()
 
 
-def main():
-    parser = argparse.ArgumentParser()
+def get_parser(add_help=True):
+    parser = argparse.ArgumentParser(add_help=add_help)
     parser.add_argument('--skey', help='Service key')
     parser.add_argument('--ukey', help='User key')
     parser.add_argument('--limit', help='Limit for search', type=int, default=20)
@@ -120,11 +294,55 @@ def main():
     parser.add_argument('--local', help='Use local dump of assignments instead of update', action='store_true')
     parser.add_argument('--debug', help='Use this key to enable debug breakpoints', action='store_true')
     parser.add_argument('--min', help='Minimum earnings (time consuming)', type=int, default=1000)
-    args = parser.parse_args()
+    parser.add_argument('--solver', help='Knapsack solver for assignment selection', choices=sorted(knapsack.SOLVERS),
+                        default='auto')
+    parser.add_argument('--ttl', help='Minutes before cached jobs of an airport are fetched again (0 refetches all)',
+                        type=float, default=const.JOB_CACHE_TTL / 60)
+    parser.add_argument('--refresh-limit', help='Maximum number of airports to refresh per run', type=int)
+    parser.add_argument('--top-k', help='Best-first search for the K best results instead of the --limit scan',
+                        type=int)
+    parser.add_argument('--rank-by', help='Earnings the --top-k search ranks by', choices=sorted(const.RENT_COLUMNS),
+                        default='DryEarnings')
+    parser.add_argument('--legs', help='Plan itineraries of up to this many legs (2-4) instead of single routes',
+                        type=int, choices=[2, 3, 4])
+    parser.add_argument('--beam', help='Beam width of the itinerary search', type=int, default=50)
+    parser.add_argument('--memo', help='File keeping distances and knapsack results between runs')
+    parser.add_argument('--memo-size', help='Maximum entries per memo cache', type=int, default=const.MEMO_SIZE)
+    parser.add_argument('--workers', help='Number of processes evaluating routes', type=int, default=1)
+    parser.add_argument('--profile', help='Print the time spent per stage and the counters after the results',
+                        action='store_true')
+    parser.add_argument('--profile-json', help='Write the per-stage breakdown as JSON to this file')
+    parser.add_argument('--cprofile', help='Run under cProfile and write the stats to this file')
+    parser.add_argument('--log-level', help='Logging level of the progress messages',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='WARNING')
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
     if not (args.skey or args.ukey):
         raise Exception('You have to provide userkey or service key')
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    profiler = None
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    with stats.timer('total'):
+        do_work(args)
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
 
-    do_work(args)
+    if args.profile:
+        print(stats.report())
+        if profiler:
+            import pstats
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    if args.profile_json:
+        with open(args.profile_json, 'w') as f:
+            f.write(stats.to_json())
 
 
 if __name__ == '__main__':
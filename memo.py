@@ -0,0 +1,91 @@
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import const
+
+MISSING = object()
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=const.MEMO_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Shared by the query threads of the service
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return '{} hits, {} misses, {} entries'.format(self.hits, self.misses, len(self))
+
+
+class Memo(object):
+    # Distances by ICAO pair and knapsack selections by route, capacities and the hash of the route's jobs.
+    # Selections are kept as job Ids, so they do not depend on the order the feed listed the jobs in. With
+    # a path the caches survive the run, so unchanged routes skip their knapsack next time.
+    def __init__(self, path=None, maxsize=const.MEMO_SIZE):
+        self.path = path
+        self.distances = LRUCache(maxsize)
+        self.assignments = LRUCache(maxsize)
+        if path and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                entries = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            # A missing or broken backing file only costs a cold cache
+            return
+        if entries.get('version') != const.MEMO_VERSION:
+            return
+        for name in ('distances', 'assignments'):
+            cache = getattr(self, name)
+            for key, value in entries.get(name, []):
+                cache.put(key, value)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = '{}.{}'.format(self.path, os.getpid())
+        with self.distances.lock, self.assignments.lock:
+            entries = {'version': const.MEMO_VERSION, 'distances': list(self.distances.entries.items()),
+                       'assignments': list(self.assignments.entries.items())}
+        with open(tmp, 'wb') as f:
+            pickle.dump(entries, f)
+        os.replace(tmp, self.path)
+
+    def stats(self):
+        return 'Distance cache: {}; assignment cache: {}'.format(self.distances.stats(), self.assignments.stats())
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+
+ICAO_COLUMNS = ['FromIcao', 'ToIcao', 'Location', 'Home']
+# Columns kept as float64 because distances, rents and earnings are rounded from them
+EXACT_COLUMNS = ['lat', 'lon', 'RentalDry', 'RentalWet', 'PctFuel']
+# Numeric in the aircraft listing even when a reply has no rows to infer that from
+AIRCRAFT_NUMERIC_COLUMNS = ['RentalDry', 'RentalWet', 'PctFuel', 'RentalTime', 'NeedsRepair']
+
+
+def normalize_columns(frame):
+    frame = frame.rename(columns=lambda column: str(column).strip())
+    return frame[[column for column in frame.columns if not column.startswith('Unnamed')]]
+
+
+def icao_dtype(airports):
+    # One categorical dictionary for every ICAO column, ordered like icaodata.csv so a code is also
+    # the airport's row in geo.AirportIndex
+    return pd.CategoricalDtype(categories=airports.icao.astype(str).to_numpy())
+
+
+def downcast(frame, exclude=()):
+    for column in frame.columns:
+        values = frame[column]
+        if column in exclude or isinstance(values.dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_bool_dtype(values.dtype):
+            continue
+        if pd.api.types.is_integer_dtype(values.dtype):
+            # Never below int32: Amount is multiplied by the passenger weight later on
+            if len(values) and values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max:
+                frame[column] = values.astype(np.int32)
+        elif pd.api.types.is_float_dtype(values.dtype):
+            if column not in EXACT_COLUMNS:
+                as_float32 = values.astype(np.float32)
+                if (as_float32.astype(np.float64) == values).all():
+                    frame[column] = as_float32
+        elif pd.api.types.infer_dtype(values, skipna=True) == 'string':
+            # is_string_dtype holds for any object column, including the numbers of a header-only reply
+            frame[column] = values.astype('category')
+    return frame
+
+
+def with_icao_codes(frame, dtype):
+    # ICAOs missing from icaodata.csv become NaN and are skipped by the assignment and airport indexes
+    for column in ICAO_COLUMNS:
+        if column in frame.columns:
+            frame[column] = frame[column].astype(str).astype(dtype)
+    return frame
+
+
+def airports(frame):
+    frame = normalize_columns(frame).copy()
+    frame.lat = frame.lat.astype(float)
+    frame.lon = frame.lon.astype(float)
+    frame.icao = frame.icao.astype(icao_dtype(frame))
+    return downcast(frame, exclude=['icao'])
+
+
+def assignments(frame, dtype):
+    frame = normalize_columns(frame).copy()
+    return downcast(with_icao_codes(frame, dtype), exclude=ICAO_COLUMNS)
+
+
+def aircraft_locations(frame, dtype):
+    frame = normalize_columns(frame).copy()
+    for column in AIRCRAFT_NUMERIC_COLUMNS:
+        if column in frame.columns:
+            frame[column] = pd.to_numeric(frame[column])
+    return downcast(with_icao_codes(frame, dtype), exclude=ICAO_COLUMNS)
@@ -0,0 +1,178 @@
+import argparse
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import const
+import main
+from fseconomy import FSEconomy
+from instrument import stats
+from jobcache import JobCache
+from memo import Memo
+
+log = logging.getLogger(__name__)
+
+# Query parameters and their types; anything else falls back to main.py's defaults
+QUERY_PARAMETERS = {'radius': int, 'min': int, 'limit': int, 'top_k': int, 'rank_by': str}
+# Loaded once and handed from one state to the next
+STATIC_ATTRIBUTES = ['all_airports', 'icao_dtype', 'airport_index', 'aircraft']
+# The aircraft listing and what is derived from it, handed over until it is older than --aircraft-ttl
+AIRCRAFT_ATTRIBUTES = ['allowed_aircraft_airports', 'airports', 'airport_grid', 'rentable_aircraft']
+
+
+class State(object):
+    # One fully loaded FSEconomy with its routes in search order. A state is never modified after it is
+    # published, so queries read it without locks while the next one is built.
+    def __init__(self, fse, aircraft_loaded=None):
+        fse.assignment_index, fse.rentable_aircraft, fse.airport_grid
+        self.fse = fse
+        self.routes = fse.get_aggregated_assignments()
+        self.countries = fse.all_airports.set_index(fse.all_airports.icao.astype(str)).country
+        self.loaded = time.time()
+        self.aircraft_loaded = aircraft_loaded or self.loaded
+
+
+class Service(object):
+    def __init__(self, args):
+        self.args = args
+        self.memo = Memo(args.memo, args.memo_size)
+        self.job_cache = JobCache(ttl=args.ttl * 60) if not args.local else None
+        self.state = None
+        self.refreshing = threading.Event()
+        self.stopped = threading.Event()
+
+    def load(self, previous=None):
+        fse = FSEconomy(self.args.local, self.args.skey, self.args.ukey, self.args.solver, job_cache=self.job_cache,
+                        refresh_limit=self.args.refresh_limit, memo=self.memo)
+        if previous is None:
+            return State(fse)
+        # icaodata.csv and aircraft.csv do not change while running; only the jobs and aircraft do
+        for name in STATIC_ATTRIBUTES:
+            setattr(fse, name, getattr(previous.fse, name))
+        if time.time() - previous.aircraft_loaded >= self.args.aircraft_ttl:
+            return State(fse)
+        # Only the jobs are refreshed, through the job cache
+        for name in AIRCRAFT_ATTRIBUTES:
+            setattr(fse, name, getattr(previous.fse, name))
+        return State(fse, previous.aircraft_loaded)
+
+    def refresh(self):
+        # The job cache only fetches airports whose jobs went stale, so a refresh is incremental online
+        self.refreshing.set()
+        try:
+            start = time.time()
+            state = self.load(self.state)
+            # Publishing is a single assignment; queries that already started keep the state they took
+            self.state = state
+            self.memo.save()
+            log.info('Refreshed %d routes in %.1fs', len(state.routes), time.time() - start)
+        except Exception:
+            log.exception('Refresh failed, still serving the state from %s', time.ctime(self.state.loaded))
+        finally:
+            self.refreshing.clear()
+
+    def run_refresh(self):
+        while not self.stopped.wait(self.args.interval):
+            self.refresh()
+
+    def query(self, parameters):
+        state = self.state
+        args = argparse.Namespace(**vars(self.args))
+        args.workers = 1
+        args.legs = None
+        for name, convert in QUERY_PARAMETERS.items():
+            if name in parameters:
+                setattr(args, name, convert(parameters[name]))
+        if args.rank_by not in const.RENT_COLUMNS:
+            raise ValueError('rank_by must be one of {}'.format(', '.join(sorted(const.RENT_COLUMNS))))
+
+        routes = state.routes
+        if parameters.get('region'):
+            # ICAO prefixes, e.g. region=K,C for the US and Canada
+            prefixes = tuple(parameters['region'].upper().split(','))
+            routes = routes[routes.FromIcao.astype(str).str.startswith(prefixes).to_numpy()]
+        if parameters.get('country'):
+            countries = state.countries.reindex(routes.FromIcao.astype(str)).to_numpy()
+            routes = routes[countries == parameters['country']]
+        return main.rank_routes(state.fse, routes, args)
+
+    def status(self):
+        state = self.state
+        return {'loaded': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(state.loaded)),
+                'aircraft_loaded': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(state.aircraft_loaded)),
+                'routes': len(state.routes), 'assignments': len(state.fse.assignment_index),
+                'refreshing': self.refreshing.is_set(), 'memo': self.memo.stats(), 'stats': stats.as_dict()}
+
+
+class Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parameters = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if url.path == '/routes':
+                with stats.timer('query'):
+                    result = self.service.query(parameters)
+                self.send_json(200, json.loads(result.to_json(orient='records')))
+            elif url.path == '/status':
+                self.send_json(200, self.service.status())
+            else:
+                self.send_json(404, {'error': 'unknown path {}'.format(url.path)})
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+        except Exception as e:
+            log.exception('Query %s failed', self.path)
+            self.send_json(500, {'error': str(e)})
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+def get_parser():
+    parser = main.get_parser()
+    parser.description = 'Keeps the data in memory and answers /routes and /status over HTTP'
+    parser.add_argument('--host', help='Address to listen on', default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen on', type=int, default=const.SERVICE_PORT)
+    parser.add_argument('--interval', help='Seconds between background refreshes', type=float,
+                        default=const.SERVICE_REFRESH_INTERVAL)
+    parser.add_argument('--aircraft-ttl', help='Seconds the aircraft listing is reused by refreshes', type=float,
+                        default=const.SERVICE_AIRCRAFT_TTL)
+    return parser
+
+
+def serve():
+    args = get_parser().parse_args()
+    if not (args.skey or args.ukey):
+        raise Exception('You have to provide userkey or service key')
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    service = Service(args)
+    service.state = service.load()
+    threading.Thread(target=service.run_refresh, daemon=True).start()
+    Handler.service = service
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print('Serving {} routes on http://{}:{}'.format(len(service.state.routes), args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stopped.set()
+        server.server_close()
+        service.memo.save()
+
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,172 @@
+import argparse
+import heapq
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+import common
+import const
+import geo
+import main
+import store
+from fseconomy import FSEconomy
+from jobcache import JobCache
+from memo import Memo
+
+log = logging.getLogger(__name__)
+
+PARTITIONS = ['country', 'prefix']
+
+
+class Shard(object):
+    def __init__(self, index, count, home, halo):
+        self.index = index
+        self.count = count
+        # Airports whose jobs this shard crawls and ranks; every airport is home to exactly one shard
+        self.home = home
+        # Home plus every airport within the search radius of it, so aircraft across the border are found
+        self.halo = halo
+
+    @property
+    def name(self):
+        return 'shard-{}-of-{}'.format(self.index, self.count)
+
+
+def get_units(airports, by, size):
+    # Maps each airport to a unit of at most size airports: a country (or ICAO prefix letter), split by state
+    # when too big, and what is still too big split into strips of longitude
+    if by == 'country':
+        keys = airports.country.astype(str).to_numpy()
+    else:
+        keys = airports.icao.astype(str).str[0].to_numpy()
+    units = pd.Series(keys, index=airports.index)
+    if by == 'country':
+        counts = units.value_counts()
+        large = units.isin(counts.index[counts > size]).to_numpy()
+        units[large] = units[large] + '/' + airports.state.astype(str).to_numpy()[large]
+    counts = units.value_counts()
+    for unit in sorted(counts.index[counts > size]):
+        rows = np.flatnonzero(units.to_numpy() == unit)
+        rows = rows[np.argsort(airports.lon.to_numpy()[rows], kind='stable')]
+        for start in range(0, len(rows), size):
+            units.iloc[rows[start:start + size]] = '{}#{}'.format(unit, start // size)
+    return units
+
+
+def make_shards(airports, count, by='country'):
+    # Balanced partition of the airport table into count lists of ICAOs: units are placed largest first on
+    # the lightest shard. Deterministic, so every machine computes the same shards on its own.
+    size = max(1, -(-len(airports) // count))
+    units = get_units(airports, by, size)
+    counts = units.value_counts()
+    order = sorted(counts.index, key=lambda unit: (-counts[unit], unit))
+    loads = [(0, i) for i in range(count)]
+    assigned = {}
+    for unit in order:
+        load, i = heapq.heappop(loads)
+        assigned[unit] = i
+        heapq.heappush(loads, (load + counts[unit], i))
+    shard_of = units.map(assigned).to_numpy()
+    icaos = airports.icao.astype(str).to_numpy()
+    return [set(icaos[shard_of == i]) for i in range(count)]
+
+
+def get_shard(airports, count, index, by='country', radius=50):
+    if not 0 <= index < count:
+        raise ValueError('Shard {} does not exist with {} shards'.format(index, count))
+    home = make_shards(airports, count, by)[index]
+    grid = geo.AirportGrid(airports)
+    icaos = airports.icao.astype(str).to_numpy()
+    halo = set(home)
+    for rows in grid.icao_within_many(sorted(home), float(radius)):
+        halo.update(icaos[rows])
+    return Shard(index, count, home, halo)
+
+
+def run_shard(args):
+    # Crawls and ranks one shard and writes its partial result under args.output
+    airports = common.load_airports()
+    shard = get_shard(airports, args.shards, args.shard, args.by, args.radius)
+    log.info('%s: %d home airports, %d with the halo', shard.name, len(shard.home), len(shard.halo))
+    job_cache = JobCache(path='{}.{}'.format(const.JOB_CACHE_FILENAME, shard.name),
+                         ttl=args.ttl * 60) if not args.local else None
+    memo = Memo(args.memo, args.memo_size)
+    fse = FSEconomy(args.local, args.skey, args.ukey, args.solver, job_cache=job_cache,
+                    refresh_limit=args.refresh_limit, memo=memo, shard=shard)
+    fse.all_airports = airports
+    result = main.rank_routes(fse, fse.get_aggregated_assignments(), args)
+    memo.save()
+    path = os.path.join(args.output, shard.name)
+    store.write_snapshot(path, result.reset_index(drop=True),
+                         extra={'shard': shard.index, 'shards': shard.count, 'by': args.by, 'radius': args.radius})
+    return path
+
+
+def merge(output, limit=None, rank_by='DryEarnings'):
+    # One global ranking from the partial results; home airports do not overlap, so neither do the rows
+    paths = sorted(os.path.join(output, name) for name in os.listdir(output)
+                   if name.startswith('shard-') and store.snapshot_exists(os.path.join(output, name)))
+    if not paths:
+        raise ValueError('No partial results in {}'.format(output))
+    extras = [store.read_extra(path) for path in paths]
+    settings = {(extra['shards'], extra['by'], extra['radius']) for extra in extras}
+    if len(settings) > 1:
+        raise ValueError('Partial results in {} come from different shardings: {}'.format(output, sorted(settings)))
+    count = extras[0]['shards']
+    missing = sorted(set(range(count)) - {extra['shard'] for extra in extras})
+    if missing:
+        log.warning('Merging without shards %s of %d', ', '.join(map(str, missing)), count)
+    frames = [store.read_snapshot(path) for path in paths]
+    frames = [frame.astype({column: str for column in frame.columns
+                            if isinstance(frame[column].dtype, pd.CategoricalDtype)}) for frame in frames]
+    result = pd.concat(frames, ignore_index=True).sort_values(rank_by, ascending=False, kind='stable')
+    return result.head(limit) if limit else result
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Splits the airports into shards that are crawled and ranked '
+                                                 'on their own and merged afterwards')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    sharding = argparse.ArgumentParser(add_help=False)
+    sharding.add_argument('--shards', help='Number of shards', type=int, required=True)
+    sharding.add_argument('--by', help='Unit kept together in one shard where possible', choices=PARTITIONS,
+                          default='country')
+
+    plan = commands.add_parser('plan', help='Show the shards', parents=[sharding])
+    plan.add_argument('--radius', help='Radius for aircraft search (nm)', type=int, default=50)
+
+    # Each shard on one machine needs its own directory: the job snapshot is written to the working directory
+    run = commands.add_parser('run', help='Crawl and rank one shard', parents=[sharding, main.get_parser(False)])
+    run.add_argument('--shard', help='Index of the shard to run', type=int, required=True)
+    run.add_argument('--output', help='Directory of the partial results', default='results')
+
+    merge_command = commands.add_parser('merge', help='Merge the partial results into one ranking')
+    merge_command.add_argument('--output', help='Directory of the partial results', default='results')
+    merge_command.add_argument('--limit', help='Number of results to show', type=int)
+    merge_command.add_argument('--rank-by', help='Earnings the ranking is sorted by',
+                               choices=sorted(const.RENT_COLUMNS), default='DryEarnings')
+    return parser
+
+
+def shard_main():
+    args = get_parser().parse_args()
+    logging.basicConfig(level=getattr(args, 'log_level', 'WARNING'),
+                        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    if args.command == 'plan':
+        airports = common.load_airports()
+        for i in range(args.shards):
+            shard = get_shard(airports, args.shards, i, args.by, args.radius)
+            print('{}: {} home airports, {} with the halo'.format(shard.name, len(shard.home), len(shard.halo)))
+    elif args.command == 'run':
+        if not (args.skey or args.ukey):
+            raise Exception('You have to provide userkey or service key')
+        print(run_shard(args))
+    else:
+        print(merge(args.output, args.limit, args.rank_by).to_string())
+
+
+if __name__ == '__main__':
+    shard_main()
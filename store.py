@@ -0,0 +1,120 @@
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+INDEX_COLUMN = '__index__'
+
+
+class SnapshotVersionError(Exception):
+    pass
+
+
+def write_snapshot(path, frame, partition_by=None, extra=None):
+    # A snapshot is a directory of one .npy file per column plus meta.json. Snapshots live in numbered
+    # generations under path and CURRENT names the live one, so replacing it is a single os.replace.
+    if partition_by is not None:
+        frame = frame.iloc[np.argsort(frame[partition_by].astype(str).to_numpy(), kind='stable')]
+    os.makedirs(path, exist_ok=True)
+    generation = '{}-{}'.format(int(time.time() * 1000), os.getpid())
+    target = os.path.join(path, generation)
+    os.makedirs(target)
+
+    columns = [(INDEX_COLUMN, frame.index.to_series(name=frame.index.name))] + list(frame.items())
+    meta = {'version': FORMAT_VERSION, 'rows': len(frame), 'index_name': frame.index.name, 'columns': [],
+            'partition_by': partition_by, 'partitions': {}, 'extra': extra or {}}
+    for i, (name, values) in enumerate(columns):
+        column = {'name': name, 'file': '{}.npy'.format(i)}
+        if isinstance(values.dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(values.dtype):
+            values = values.astype('category')
+            column['categories'] = values.cat.categories.astype(str).tolist()
+            data = values.cat.codes.to_numpy()
+        elif values.dtype.kind == 'M':
+            column['datetime'] = True
+            data = values.to_numpy().astype('datetime64[ns]').view(np.int64)
+        else:
+            data = values.to_numpy()
+        np.save(os.path.join(target, column['file']), data, allow_pickle=False)
+        meta['columns'].append(column)
+
+    if partition_by is not None and len(frame):
+        keys = frame[partition_by].astype(str).to_numpy()
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        ends = np.r_[starts[1:], len(keys)]
+        meta['partitions'] = {keys[s]: [int(s), int(e)] for s, e in zip(starts, ends)}
+
+    with open(os.path.join(target, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    current_tmp = os.path.join(path, 'CURRENT.{}'.format(generation))
+    with open(current_tmp, 'w') as f:
+        f.write(generation)
+    os.replace(current_tmp, os.path.join(path, 'CURRENT'))
+
+    # Keep the previous generation around for readers that resolved CURRENT just before the swap
+    generations = sorted(name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name)))
+    for name in generations[:-2]:
+        shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+def snapshot_exists(path):
+    return os.path.exists(os.path.join(path, 'CURRENT'))
+
+
+def read_meta(path):
+    with open(os.path.join(path, 'CURRENT')) as f:
+        generation = f.read().strip()
+    target = os.path.join(path, generation)
+    with open(os.path.join(target, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['version'] != FORMAT_VERSION:
+        raise SnapshotVersionError('{} has format version {}, expected {}'.format(path, meta['version'],
+                                                                                  FORMAT_VERSION))
+    return target, meta
+
+
+def read_snapshot(path, columns=None, where=None):
+    # columns projects, where maps a column to the values to keep; on the partition column only the
+    # matching row ranges are read from the memory-mapped files. Numeric columns stay memory-mapped unless
+    # the ranges are scattered; pandas copies them on write.
+    target, meta = read_meta(path)
+    where = dict(where or {})
+    rows = None
+    partition_by = meta['partition_by']
+    if partition_by in where:
+        ranges = sorted(meta['partitions'][key] for key in set(map(str, where.pop(partition_by)))
+                        if key in meta['partitions'])
+        if len(ranges) == 1:
+            rows = slice(*ranges[0])
+        else:
+            rows = np.concatenate([np.arange(s, e) for s, e in ranges]) if ranges else np.empty(0, int)
+
+    wanted = set(columns) | set(where) if columns is not None else None
+    data = {}
+    for column in meta['columns']:
+        name = column['name']
+        if wanted is not None and name != INDEX_COLUMN and name not in wanted:
+            continue
+        values = np.load(os.path.join(target, column['file']), mmap_mode='r', allow_pickle=False)
+        if rows is not None:
+            values = values[rows]
+        if 'categories' in column:
+            values = pd.Categorical.from_codes(values, categories=column['categories'])
+        elif column.get('datetime'):
+            values = values.view('datetime64[ns]')
+        data[name] = values
+
+    index = pd.Index(data.pop(INDEX_COLUMN), name=meta['index_name'])
+    frame = pd.DataFrame(data, index=index, copy=False)
+    for name, values in where.items():
+        frame = frame[frame[name].isin(values)]
+    if columns is not None:
+        frame = frame[[name for name in columns if name in frame.columns]]
+    return frame
+
+
+def read_extra(path):
+    return read_meta(path)[1]['extra']
@@ -0,0 +1,92 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import fetch
+
+MINIMUM_DELAY = 'Your request was under the minimum delay'
+TOO_MANY = 'To many requests. You have made too many requests in 60 second period'
+MAINTENANCE = 'The server is Currently Closed for Maintenance'
+
+
+class StubFeed(BaseHTTPRequestHandler):
+    # Answers each path with its scripted replies in turn and repeats the last one
+    protocol_version = 'HTTP/1.1'
+    replies = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        path = self.path.split('&servicekey=')[0]
+        with self.lock:
+            replies = self.replies[path]
+            status, body = replies.pop(0) if len(replies) > 1 else replies[0]
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/csv; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def feed():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubFeed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    StubFeed.replies = {}
+
+    def reply(name, *replies):
+        path = '/data?query={}'.format(name)
+        StubFeed.replies[path] = list(replies)
+        return 'http://127.0.0.1:{}{}'.format(server.server_address[1], path)
+
+    yield reply
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fetcher():
+    return fetch.Fetcher('test', rate_limits={'servicekey': (1000, 10)}, retry_count=5, retry_interval=0.01,
+                         max_retry_interval=0.05)
+
+
+def csv(i):
+    return 'Id,Pay\n{},{}\n'.format(i, i * 100)
+
+
+def test_get_frame_retries_throttling(feed, fetcher):
+    link = feed('jobs', (200, MINIMUM_DELAY), (200, TOO_MANY), (200, csv(1)))
+    frame = fetcher.get_frame(link)
+    assert frame.index.tolist() == [1]
+    assert frame.Pay.tolist() == [100]
+
+
+def test_map_returns_every_frame_in_order(feed, fetcher):
+    links = [feed('jobs{}'.format(i), *([(200, TOO_MANY)] * (i % 3) + [(200, csv(i))])) for i in range(10)]
+    frames = list(fetcher.map(links, fetch=fetcher.get_frame))
+    assert [frame.index.tolist() for frame in frames] == [[i] for i in range(10)]
+
+
+def test_maintenance_is_not_retried(feed, fetcher):
+    link = feed('jobs', (200, MAINTENANCE), (200, csv(1)))
+    with pytest.raises(fetch.ServerUnreachableException):
+        fetcher.get_frame(link)
+    with pytest.raises(fetch.ServerUnreachableException):
+        fetcher.get(feed('aircraft', (200, MAINTENANCE)))
+
+
+
+def test_server_errors_are_retried(feed, fetcher):
+    link = feed('jobs', (503, 'busy'), (429, 'slow down'), (502, 'bad gateway'), (200, csv(2)))
+    assert fetcher.get_frame(link).index.tolist() == [2]
+    with pytest.raises(fetch.ServerUnreachableException):
+        fetcher.get(feed('missing', (404, 'not found')))
+
+
+def test_empty_body_is_retried(feed, fetcher):
+    link = feed('jobs', (200, ''), (200, csv(3)))
+    assert fetcher.get_frame(link).index.tolist() == [3]
@@ -0,0 +1,13 @@
+import pytest
+
+import itinerary
+
+
+@pytest.mark.parametrize('max_legs', [2, 3, 4])
+def test_plan_itineraries_without_routes(fse, monkeypatch, max_legs):
+    origins = list(dict.fromkeys(fse.get_aggregated_assignments().FromIcao.astype(str)))[:5]
+    empty = fse.get_aggregated_assignments().iloc[:0]
+    monkeypatch.setattr(fse, 'get_aggregated_assignments', lambda: empty)
+    result = itinerary.plan_itineraries(fse, origins, 100, 10, max_legs)
+    assert list(result.columns) == itinerary.ITINERARY_COLUMNS
+    assert not len(result)
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import const
+import knapsack
+
+pytest.importorskip('pulp')
+
+SEEDS = range(25)
+
+
+def make_instance(seed):
+    # Passenger jobs use seats and their weight, cargo jobs only weight, like get_weighted_assignments
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(1, 16))
+    is_passengers = rng.random(n) < 0.5
+    amount = np.where(is_passengers, rng.integers(1, 10, n), rng.integers(50, 2000, n))
+    passengers = np.where(is_passengers, amount, 0)
+    weight = np.where(is_passengers, amount * const.PAX_WEIGHT_KG, amount)
+    pay = rng.integers(100, 20000, n)
+    max_passengers = int(rng.integers(0, max(1, passengers.sum())))
+    max_weight = int(rng.integers(0, max(1, weight.sum())))
+    return pay, passengers, weight, max_passengers, max_weight
+
+
+def check(selected, pay, passengers, weight, max_passengers, max_weight):
+    assert passengers[selected].sum() <= max_passengers
+    assert weight[selected].sum() <= max_weight
+    return pay[selected].sum()
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('engine', [knapsack.solve_dp, knapsack.solve_branch_and_bound, knapsack.solve])
+def test_matches_pulp(engine, seed):
+    pay, passengers, weight, max_passengers, max_weight = make_instance(seed)
+    expected = check(knapsack.solve_pulp(pay.tolist(), passengers.tolist(), weight.tolist(), max_passengers,
+                                         max_weight), pay, passengers, weight, max_passengers, max_weight)
+    selected = engine(pay, passengers, weight, max_passengers, max_weight)
+    assert check(selected, pay, passengers, weight, max_passengers, max_weight) == expected
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_fractional_weights_fall_back_from_dp(seed):
+    pay, passengers, weight, max_passengers, max_weight = make_instance(seed)
+    weight = weight + 0.5
+    assert knapsack.solve_dp(pay, passengers, weight, max_passengers, max_weight) is None
+    expected = check(knapsack.solve_pulp(pay.tolist(), passengers.tolist(), weight.tolist(), max_passengers,
+                                         max_weight), pay, passengers, weight, max_passengers, max_weight)
+    selected = knapsack.solve(pay, passengers, weight, max_passengers, max_weight)
+    assert check(selected, pay, passengers, weight, max_passengers, max_weight) == expected
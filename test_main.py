@@ -0,0 +1,22 @@
+import pytest
+
+import main
+
+
+def get_args(*args):
+    return main.get_parser().parse_args(['--local', '--skey', 'test'] + list(args))
+
+
+@pytest.mark.parametrize('args', [[], ['--top-k', '5'], ['--top-k', '5', '--rank-by', 'WetEarnings']])
+def test_rank_routes_without_routes(fse, args):
+    routes = fse.get_aggregated_assignments().iloc[:0]
+    result = main.rank_routes(fse, routes, get_args(*args))
+    assert list(result.columns) == main.RESULT_COLUMNS
+    assert not len(result)
+
+
+def test_rank_routes_top_k_is_sorted_by_rank(fse):
+    result = main.rank_routes(fse, fse.get_aggregated_assignments(), get_args('--top-k', '5', '--radius', '100',
+                                                                             '--rank-by', 'WetEarnings'))
+    assert len(result) <= 5
+    assert list(result.WetEarnings) == sorted(result.WetEarnings, reverse=True)